@@ -0,0 +1,352 @@
+"""
+Generate a synthetic Netbox fleet, and the matching data of the external sources the reports check against.
+
+Everything is created with bulk inserts, bypassing the models' save() logic, so this is only meant for throwaway
+databases. A small share of the objects is deliberately broken (malformed names, missing asset tags, duplicate
+serials, unracked devices, blank cable labels...) so that the reports also go through their failure paths.
+"""
+
+import csv
+import datetime
+import itertools
+import random
+
+from django.contrib.contenttypes.models import ContentType
+
+from dcim.constants import (
+    DEVICE_STATUS_ACTIVE,
+    DEVICE_STATUS_INVENTORY,
+    DEVICE_STATUS_OFFLINE,
+    DEVICE_STATUS_PLANNED,
+    IFACE_TYPE_1GE_FIXED,
+)
+from dcim.models import (
+    Cable,
+    ConsolePort,
+    ConsoleServerPort,
+    Device,
+    DeviceRole,
+    DeviceType,
+    Interface,
+    InventoryItem,
+    Manufacturer,
+    PowerOutlet,
+    PowerPort,
+    Rack,
+    Site,
+)
+from extras.constants import CF_TYPE_DATE, CF_TYPE_TEXT
+from extras.models import CustomField, CustomFieldValue
+from virtualization.models import Cluster, ClusterType, VirtualMachine
+
+BATCH_SIZE = 1000
+
+# (manufacturer slug, model, role slug, weight) of the generated devices
+DEVICE_MODELS = (
+    ("dell", "PowerEdge R440", "server", 80),
+    ("juniper", "EX4300-48T", "asw", 6),
+    ("juniper", "MX480", "cr", 2),
+    ("juniper", "SRX1500", "pfw", 1),
+    ("juniper", "MX104", "mr", 1),
+    ("netgear", "GS728TP", "msw", 2),
+    ("sentry", "Smart CDU", "pdu", 6),
+    ("opengear", "CM7148", "scs", 2),
+)
+
+# (status, weight) of the generated devices
+DEVICE_STATUSES = (
+    (DEVICE_STATUS_ACTIVE, 90),
+    (DEVICE_STATUS_OFFLINE, 4),
+    (DEVICE_STATUS_PLANNED, 3),
+    (DEVICE_STATUS_INVENTORY, 3),
+)
+
+
+class Fleet:
+    """A synthetic fleet, as created in Netbox, with the data the external sources would have about it."""
+
+    def __init__(self, devices=1000, interfaces=4, inventory=2, vms=None, sites=5, racks=20, seed=0):
+        """Set the size of the fleet.
+
+        Arguments:
+            devices (int): the number of devices.
+            interfaces (int): the number of interfaces per device.
+            inventory (int): the number of inventory items per network device.
+            vms (int, optional): the number of virtual machines, a fifth of the devices if not given.
+            sites (int): the number of sites.
+            racks (int): the number of racks per site.
+            seed (int): the seed of the random generator, so that the fleet is reproducible.
+
+        """
+        self.size = {
+            "devices": devices,
+            "interfaces": interfaces,
+            "inventory": inventory,
+            "vms": devices // 5 if vms is None else vms,
+            "sites": sites,
+            "racks": racks,
+        }
+        self.random = random.Random(seed)
+        self.devices = []
+        self.inventory_items = []
+        self.vms = []
+
+    def create(self):
+        """Create the whole fleet in Netbox."""
+        self._create_sites()
+        self._create_device_types()
+        self._create_custom_fields()
+        self._create_devices()
+        self._create_components()
+        self._create_cables()
+        self._create_inventory()
+        self._create_vms()
+
+    def _create_sites(self):
+        self.sites = Site.objects.bulk_create(
+            Site(name="Site {}".format(i), slug="site{}".format(i), physical_address="{} Main St, city{}".format(i, i))
+            for i in range(self.size["sites"])
+        )
+        self.racks = Rack.objects.bulk_create(
+            (
+                Rack(name="{}{}".format(chr(ord("A") + i // 10), i % 10), site=site)
+                for site, i in itertools.product(self.sites, range(self.size["racks"]))
+            ),
+            batch_size=BATCH_SIZE,
+        )
+
+    def _create_device_types(self):
+        self.manufacturers = {
+            manufacturer.slug: manufacturer
+            for manufacturer in Manufacturer.objects.bulk_create(
+                Manufacturer(name=slug.title(), slug=slug) for slug in sorted({model[0] for model in DEVICE_MODELS})
+            )
+        }
+        roles = sorted({model[2] for model in DEVICE_MODELS})
+        self.roles = {
+            role.slug: role
+            for role in DeviceRole.objects.bulk_create(
+                DeviceRole(name=slug, slug=slug, color="9e9e9e") for slug in roles
+            )
+        }
+        self.device_types = DeviceType.objects.bulk_create(
+            DeviceType(manufacturer=self.manufacturers[manufacturer], model=model, slug=model.lower().replace(" ", "-"))
+            for manufacturer, model, _, _ in DEVICE_MODELS
+        )
+
+    def _create_custom_fields(self):
+        content_type = ContentType.objects.get_for_model(Device)
+        self.custom_fields = {}
+        for name, type in (("purchase_date", CF_TYPE_DATE), ("ticket", CF_TYPE_TEXT)):
+            field = CustomField.objects.create(name=name, type=type)
+            field.obj_type.set([content_type])
+            self.custom_fields[name] = field
+
+    def _create_devices(self):
+        models = [(device_type, model[2]) for device_type, model in zip(self.device_types, DEVICE_MODELS)]
+        model_weights = [model[3] for model in DEVICE_MODELS]
+        statuses = [status for status, _ in DEVICE_STATUSES]
+        status_weights = [weight for _, weight in DEVICE_STATUSES]
+
+        devices = []
+        for i in range(self.size["devices"]):
+            device_type, role = self.random.choices(models, model_weights)[0]
+            status = self.random.choices(statuses, status_weights)[0]
+            name = "{}{}".format(role, 1000 + i)
+            if self.random.random() < 0.01:
+                name = name.upper()
+            serial = "SN{:08d}".format(i)
+            if self.random.random() < 0.005:
+                serial = "SN{:08d}".format(max(i - 1, 0))
+            elif self.random.random() < 0.005:
+                serial = ""
+            rack = self.random.choice(self.racks)
+            if self.random.random() < 0.01:
+                rack = None
+            asset_tag = "WMF{:04d}".format(i) if self.random.random() > 0.01 else None
+            devices.append(
+                Device(
+                    device_type=device_type,
+                    device_role=self.roles[role],
+                    site=self.sites[0] if rack is None else rack.site,
+                    rack=rack,
+                    name=name,
+                    serial=serial,
+                    asset_tag=asset_tag,
+                    status=status,
+                )
+            )
+        self.devices = Device.objects.bulk_create(devices, batch_size=BATCH_SIZE)
+
+        today = datetime.date.today()
+        values = []
+        content_type = ContentType.objects.get_for_model(Device)
+        for device in self.devices:
+            if self.random.random() > 0.01:
+                purchase_date = today - datetime.timedelta(days=self.random.randrange(-10, 5 * 365))
+                values.append(
+                    CustomFieldValue(
+                        field=self.custom_fields["purchase_date"],
+                        obj_type=content_type,
+                        obj_id=device.pk,
+                        serialized_value=purchase_date.isoformat(),
+                    )
+                )
+            if self.random.random() > 0.01:
+                values.append(
+                    CustomFieldValue(
+                        field=self.custom_fields["ticket"],
+                        obj_type=content_type,
+                        obj_id=device.pk,
+                        serialized_value="T{}".format(100000 + device.pk),
+                    )
+                )
+        CustomFieldValue.objects.bulk_create(values, batch_size=BATCH_SIZE)
+
+    def _create_components(self):
+        interfaces = []
+        console_ports = []
+        console_server_ports = []
+        power_ports = []
+        power_outlets = []
+        for device in self.devices:
+            role = device.device_role.slug
+            for i in range(self.size["interfaces"]):
+                if role == "server":
+                    name = "eno{}".format(i + 1) if i else "mgmt"
+                else:
+                    name = "xe-0/0/{}".format(i)
+                if self.random.random() < 0.001:
+                    name = "Bad Name {}".format(i)
+                interfaces.append(Interface(device=device, name=name, type=IFACE_TYPE_1GE_FIXED))
+
+            if role == "scs":
+                console_server_ports.extend(
+                    ConsoleServerPort(device=device, name="port{}".format(i + 1)) for i in range(48)
+                )
+            elif role == "pdu":
+                power_outlets.extend(PowerOutlet(device=device, name=str(i + 1)) for i in range(24))
+            else:
+                if role != "server":
+                    console_ports.append(
+                        ConsolePort(device=device, name="console0", connection_status=self.random.random() > 0.05)
+                    )
+                power_ports.extend(PowerPort(device=device, name="PSU{}".format(i + 1)) for i in range(2))
+
+        self.interfaces = Interface.objects.bulk_create(interfaces, batch_size=BATCH_SIZE)
+        self.console_ports = ConsolePort.objects.bulk_create(console_ports, batch_size=BATCH_SIZE)
+        ConsoleServerPort.objects.bulk_create(console_server_ports, batch_size=BATCH_SIZE)
+        self.power_ports = PowerPort.objects.bulk_create(power_ports, batch_size=BATCH_SIZE)
+        PowerOutlet.objects.bulk_create(power_outlets, batch_size=BATCH_SIZE)
+
+    def _create_cables(self):
+        interface_type = ContentType.objects.get_for_model(Interface)
+        cables = []
+        # cable the interfaces pairwise, in creation order
+        for i, (a, b) in enumerate(zip(self.interfaces[::2], self.interfaces[1::2])):
+            label = "{:06d}".format(i)
+            if self.random.random() < 0.01:
+                label = ""
+            elif self.random.random() < 0.005:
+                label = "{:06d}".format(max(i - 1, 0))
+            cables.append(
+                Cable(
+                    termination_a_type=interface_type,
+                    termination_a_id=a.pk,
+                    termination_b_type=interface_type,
+                    termination_b_id=b.pk,
+                    label=label,
+                    status=True,
+                )
+            )
+        Cable.objects.bulk_create(cables, batch_size=BATCH_SIZE)
+
+    def _create_inventory(self):
+        inventory_items = []
+        for device in self.devices:
+            if device.device_role.slug in ("server", "pdu", "scs"):
+                continue
+            manufacturer = device.device_type.manufacturer
+            for i in range(self.size["inventory"]):
+                inventory_items.append(
+                    InventoryItem(
+                        device=device,
+                        name="FPC {}".format(i),
+                        manufacturer=manufacturer,
+                        part_id="PART-{}".format(i),
+                        serial="INV{:08d}{}".format(device.pk, i),
+                    )
+                )
+        self.inventory_items = InventoryItem.objects.bulk_create(inventory_items, batch_size=BATCH_SIZE)
+
+    def _create_vms(self):
+        cluster_type = ClusterType.objects.create(name="Ganeti", slug="ganeti")
+        cluster = Cluster.objects.create(name="ganeti01", type=cluster_type)
+        self.vms = VirtualMachine.objects.bulk_create(
+            (
+                VirtualMachine(name="vm{}".format(1000 + i), cluster=cluster, status=DEVICE_STATUS_ACTIVE)
+                for i in range(self.size["vms"])
+            ),
+            batch_size=BATCH_SIZE,
+        )
+
+    def _sample(self, objects, share=0.98):
+        """Get a reproducible subset of the given objects, as the external sources never perfectly match Netbox."""
+        return [obj for obj in objects if self.random.random() < share]
+
+    def puppetdb_facts(self):
+        """Get the facts PuppetDB would have about the fleet, keyed by fact name."""
+        facts = {"serialnumber": {}, "is_virtual": {}, "productname": {}}
+        for device in self._sample(self.devices):
+            if device.device_role.slug != "server":
+                continue
+            facts["serialnumber"][device.name] = device.serial
+            facts["is_virtual"][device.name] = False
+            facts["productname"][device.name] = device.device_type.model
+        for vm in self._sample(self.vms):
+            facts["is_virtual"][vm.name] = True
+        return facts
+
+    def librenms_rows(self):
+        """Get the rows the LibreNMS devices and entPhysical tables would have about the fleet.
+
+        Returns:
+            tuple: the lists of (id, hardware, description, serial, hostname) device rows and of (serial, model,
+            vendor) entPhysical rows, normalized as selected by the LibreNMS report.
+
+        """
+        devices = []
+        for device in self._sample(self.devices):
+            if device.device_role.slug == "server" or not device.serial:
+                continue
+            manufacturer = device.device_type.manufacturer.name.lower()
+            model = device.device_type.model.lower()
+            devices.append((device.pk, model, "{} {} rev. 1".format(manufacturer, model), device.serial, device.name))
+        inventory = [
+            (item.serial, "fpc", item.manufacturer.name.lower()) for item in self._sample(self.inventory_items)
+        ]
+        return devices, inventory
+
+    def write_juniper_installed_base(self, path):
+        """Write the CSV export of the Juniper installed base of the fleet to the given path."""
+        with open(path, "w", newline="") as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(("Serial #", "Product Name", "Install City", "Status", "Contract End Date"))
+            for device in self._sample(self.devices):
+                if device.device_type.manufacturer.slug != "juniper" or not device.serial:
+                    continue
+                status = "Active" if self.random.random() > 0.02 else "Expired"
+                city = device.site.physical_address.rsplit(", ", 1)[1]
+                writer.writerow((device.serial, device.device_type.model, city, status, "2030-01-01"))
+            for item in self._sample(self.inventory_items):
+                if item.manufacturer.slug == "juniper":
+                    writer.writerow((item.serial, item.part_id, "", "Active", ""))
+
+    def accounting_values(self):
+        """Get the values of the accounting spreadsheet about the fleet, as returned by the Google Sheets API."""
+        values = [["Data Center Equipment Asset Tags"], ["Date", "Serial Number", "Asset Tag#", "RT#"]]
+        for device in self._sample(self.devices):
+            if not device.serial or not device.asset_tag:
+                continue
+            values.append(["01/15/2019", device.serial, device.asset_tag, "T{}".format(100000 + device.pk)])
+        return values
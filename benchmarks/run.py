@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+"""
+Benchmark the reports against a synthetic fleet.
+
+For each test of each report, measure the wall time, the number of SQL queries and the peak memory allocated, and
+optionally save them as a baseline or compare them against a previously saved one to catch regressions.
+
+This needs a Netbox installation configured with a local, throwaway database. The synthetic fleet is created in a
+transaction which is rolled back at the end, and the external sources (PuppetDB, LibreNMS, the Juniper installed
+base CSV and the accounting spreadsheet) are replaced by local stand-ins generated from the same fleet. For example:
+
+    benchmarks/run.py --netbox /opt/netbox/netbox --devices 10000 --save baseline.json
+    benchmarks/run.py --netbox /opt/netbox/netbox --devices 10000 --compare baseline.json
+"""
+
+import argparse
+import configparser
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, OrderedDict
+
+REPORTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "reports")
+
+# (module, class) of the reports to benchmark, in run order
+REPORTS = (
+    ("coherence", "Coherence"),
+    ("cables", "Cables"),
+    ("management", "ManagementConsole"),
+    ("puppetdb", "PuppetDB"),
+    ("librenms", "LibreNMS"),
+    ("juniper", "Juniper"),
+    ("accounting", "Accounting"),
+)
+
+# Timing differences below this many seconds are considered noise when comparing against a baseline
+TIME_NOISE = 0.05
+
+
+class _FakeRequest:
+    """Stand-in for a Google API request, returning a fixed result."""
+
+    def __init__(self, result):
+        self._result = result
+
+    def execute(self):
+        return self._result
+
+
+class FakeSheets:
+    """Stand-in for the Google Sheets API resource, serving fixed spreadsheet values."""
+
+    def __init__(self, values):
+        self._values = values
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        return _FakeRequest({"values": self._values})
+
+
+class FakeDrive:
+    """Stand-in for the Google Drive API resource, serving a fixed file version."""
+
+    def files(self):
+        return self
+
+    def get(self, **kwargs):
+        return _FakeRequest({"version": "1"})
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--netbox", default="/opt/netbox/netbox", help="the Netbox directory, containing manage.py")
+    parser.add_argument("--devices", type=int, default=1000, help="the number of devices of the fleet")
+    parser.add_argument("--interfaces", type=int, default=4, help="the number of interfaces per device")
+    parser.add_argument("--inventory", type=int, default=2, help="the number of inventory items per network device")
+    parser.add_argument("--vms", type=int, help="the number of VMs, a fifth of the devices by default")
+    parser.add_argument("--sites", type=int, default=5, help="the number of sites")
+    parser.add_argument("--seed", type=int, default=0, help="the seed of the synthetic fleet")
+    parser.add_argument("--reports", nargs="+", help="only benchmark these report classes")
+    parser.add_argument("--no-memory", action="store_true", help="don't trace memory, which slows the tests down")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline to FILE")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results against the baseline in FILE")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25, help="relative time and memory increase considered a regression"
+    )
+    return parser.parse_args(argv)
+
+
+def setup_django(netbox_dir):
+    """Set up Django with the Netbox settings, and make the reports importable."""
+    sys.path[:0] = [netbox_dir, REPORTS_DIR]
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "netbox.settings")
+
+    import django
+
+    django.setup()
+
+
+def install_standins(report, fleet, tmpdir):
+    """Replace the external data sources of a report with local stand-ins generated from the fleet."""
+    from _common import DataProvider, log_load_time
+
+    name = type(report).__name__
+    if name == "PuppetDB":
+        facts = fleet.puppetdb_facts()
+        report.sources = DataProvider(on_load=log_load_time(report), facts=lambda: facts)
+    elif name == "LibreNMS":
+        from librenms import LibreNMSData
+
+        devices, inventory = fleet.librenms_rows()
+
+        def load_librenms():
+            data = LibreNMSData()
+            data.load_devices(devices)
+            data.load_inventory(inventory)
+            # the duplicates are counted by MySQL in production
+            for duplicates, serials in (
+                (data.device_duplicates, Counter(row[3] for row in devices)),
+                (data.inventory_duplicates, Counter(row[0] for row in inventory)),
+            ):
+                duplicates.update((serial, count) for serial, count in serials.items() if count > 1)
+            return data
+
+        report.sources = DataProvider(on_load=log_load_time(report), librenms=load_librenms)
+    elif name == "Juniper":
+        csv_path = os.path.join(tmpdir, "juniper_installed_base.csv")
+        fleet.write_juniper_installed_base(csv_path)
+        cache_path = os.path.join(tmpdir, "juniper_installed_base.json")
+        report.sources = DataProvider(
+            on_load=log_load_time(report), installed_base=lambda: report.load_installed_base(csv_path, cache_path)
+        )
+    elif name == "Accounting":
+        config = configparser.ConfigParser(interpolation=None)
+        config["accounting"] = {
+            "sheet_id": "synthetic",
+            "range": "A:D",
+            "cache_file": os.path.join(tmpdir, "accounting_assets.json"),
+            "cache_ttl": "0",
+        }
+        sheets = FakeSheets(fleet.accounting_values())
+        report.sources = DataProvider(
+            on_load=log_load_time(report), assets=lambda: report.load_assets(config, sheets=sheets, drive=FakeDrive()),
+        )
+
+
+def run_test(report, method_name, trace_memory):
+    """Run a single test of a report, the same way Netbox does, and measure it.
+
+    Returns:
+        dict: the wall time in seconds, the number of queries, the peak memory allocated in bytes (or None if not
+        traced) and the number of log entries of the test.
+
+    """
+    from django.db import connection
+
+    queries = 0
+
+    def count_queries(execute, sql, params, many, context):
+        nonlocal queries
+        queries += 1
+        return execute(sql, params, many, context)
+
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with connection.execute_wrapper(count_queries):
+        report.active_test = method_name
+        getattr(report, method_name)()
+    elapsed = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return OrderedDict(
+        (
+            ("time", elapsed),
+            ("queries", queries),
+            ("peak_memory", peak_memory),
+            ("log_entries", len(report._results[method_name]["log"])),
+        )
+    )
+
+
+def run_reports(fleet, report_names=None, trace_memory=True):
+    """Run all the tests of the selected reports against the fleet.
+
+    Returns:
+        collections.OrderedDict: the measurements of each test, keyed by "Report.test_name".
+
+    """
+    import importlib
+
+    import _common
+
+    results = OrderedDict()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        # Measure full runs, without ever touching the incremental store of the production config
+        config_file = os.path.join(tmpdir, "reports.cfg")
+        with open(config_file, "w") as f:
+            f.write("[incremental]\nenabled = false\nstore = {}\n".format(os.path.join(tmpdir, "incremental.sqlite")))
+        production_config_file, _common.CONFIG_FILE = _common.CONFIG_FILE, config_file
+        try:
+            for module_name, class_name in REPORTS:
+                if report_names and class_name not in report_names:
+                    continue
+                report = getattr(importlib.import_module(module_name), class_name)()
+                install_standins(report, fleet, tmpdir)
+                for method_name in report.test_methods:
+                    key = "{}.{}".format(class_name, method_name)
+                    results[key] = run_test(report, method_name, trace_memory)
+                    print_result(key, results[key])
+        finally:
+            _common.CONFIG_FILE = production_config_file
+    return results
+
+
+def print_result(key, result):
+    memory = "-" if result["peak_memory"] is None else "{:.1f}MiB".format(result["peak_memory"] / 2 ** 20)
+    print(
+        "{:<60} {:>9.3f}s {:>8} queries {:>10} {:>7} log entries".format(
+            key, result["time"], result["queries"], memory, result["log_entries"]
+        ),
+        flush=True,
+    )
+
+
+def compare(results, baseline, tolerance):
+    """Compare the results against a baseline.
+
+    Returns:
+        list: the descriptions of the regressions found.
+
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["time"] > base["time"] * (1 + tolerance) and result["time"] - base["time"] > TIME_NOISE:
+            regressions.append("{}: time {:.3f}s -> {:.3f}s".format(key, base["time"], result["time"]))
+        if result["queries"] > base["queries"]:
+            regressions.append("{}: queries {} -> {}".format(key, base["queries"], result["queries"]))
+        if (
+            result["peak_memory"] is not None
+            and base["peak_memory"] is not None
+            and result["peak_memory"] > base["peak_memory"] * (1 + tolerance)
+        ):
+            regressions.append("{}: peak memory {} -> {} bytes".format(key, base["peak_memory"], result["peak_memory"]))
+        if result["log_entries"] != base["log_entries"]:
+            regressions.append("{}: log entries {} -> {}".format(key, base["log_entries"], result["log_entries"]))
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    setup_django(args.netbox)
+
+    from django.db import transaction
+
+    from fleet import Fleet
+
+    fleet = Fleet(
+        devices=args.devices,
+        interfaces=args.interfaces,
+        inventory=args.inventory,
+        vms=args.vms,
+        sites=args.sites,
+        seed=args.seed,
+    )
+    with transaction.atomic():
+        start = time.perf_counter()
+        fleet.create()
+        print("Created fleet {} in {:.1f}s".format(fleet.size, time.perf_counter() - start), flush=True)
+        results = run_reports(fleet, args.reports, not args.no_memory)
+        transaction.set_rollback(True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"fleet": fleet.size, "results": results}, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline["fleet"] != fleet.size:
+            print("WARNING: the baseline was taken with a different fleet: {}".format(baseline["fleet"]))
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION {}".format(regression))
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,85 @@
+"""
+First-fit allocation of IP addresses, independent of Netbox, for the scripts.
+"""
+
+import bisect
+import ipaddress
+
+
+class FirstFitAllocator:
+    """First-fit allocator of the free addresses of a network, working from a sorted index of the used ones.
+
+    Finding the first free address at or after a given one takes O(log n) in the number of used addresses, whatever
+    the size of the network and of the runs of consecutive used addresses.
+    """
+
+    def __init__(self, network, used=(), reserve_ends=None):
+        """Index the used addresses.
+
+        Arguments:
+            network (str, ipaddress.IPv4Network, ipaddress.IPv6Network): the network to allocate addresses from.
+            used (iterable): the used addresses, as anything accepted by ipaddress.ip_address(), including integers.
+                The addresses outside of the network are ignored.
+            reserve_ends (bool, optional): whether the first and last addresses of the network can't be allocated. By
+                default they are reserved unless the network is point-to-point (an IPv4 /31 or an IPv6 /127), as
+                Netbox does for non-pool prefixes, leaving nothing to allocate in an IPv4 /32 or an IPv6 /128.
+
+        """
+        self.network = ipaddress.ip_network(str(network))
+        if reserve_ends is None:
+            reserve_ends = self.network.prefixlen != self.network.max_prefixlen - 1
+
+        self._first = int(self.network.network_address)
+        self._last = int(self.network.broadcast_address)
+        if reserve_ends:
+            self._first += 1
+            self._last -= 1
+
+        self._used = sorted(
+            {
+                address
+                for address in (int(ipaddress.ip_address(used_address)) for used_address in used)
+                if self._first <= address <= self._last
+            }
+        )
+
+    def first_free(self, start=None):
+        """Find the first free address, at or after start if given.
+
+        Arguments:
+            start (optional): the address to start from, as anything accepted by ipaddress.ip_address().
+
+        Returns:
+            ipaddress.IPv4Address, ipaddress.IPv6Address: the first free address, or None if there is none left.
+
+        """
+        candidate = self._first if start is None else max(self._first, int(ipaddress.ip_address(start)))
+        i = bisect.bisect_left(self._used, candidate)
+        if i < len(self._used) and self._used[i] == candidate:
+            # The candidate is in a run of consecutive used addresses: find its end by bisection, relying on the used
+            # addresses being unique and sorted, so that they are consecutive from i up to j iff used[j] - used[i]
+            # equals j - i.
+            lo, hi = i, len(self._used) - 1
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self._used[mid] - self._used[i] == mid - i:
+                    lo = mid
+                else:
+                    hi = mid - 1
+            candidate = self._used[lo] + 1
+
+        if candidate > self._last:
+            return None
+        return ipaddress.ip_address(candidate)
+
+    def allocate(self, start=None):
+        """Find the first free address like first_free(), and mark it as used.
+
+        Returns:
+            ipaddress.IPv4Address, ipaddress.IPv6Address: the allocated address, or None if there is none left.
+
+        """
+        address = self.first_free(start)
+        if address is not None:
+            bisect.insort(self._used, int(address))
+        return address
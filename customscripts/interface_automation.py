@@ -1,12 +1,104 @@
 import ipaddress
+from collections import Counter, OrderedDict
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import router, transaction
+from django.db.models.signals import post_save
 
 from dcim.constants import IFACE_TYPE_1GE_FIXED
-from dcim.models import Device, Interface
+from dcim.models import Device, Interface, Rack, Site
 from ipam.constants import IPADDRESS_STATUS_ACTIVE
 from ipam.models import Prefix, IPAddress
-from extras.scripts import Script, ObjectVar, BooleanVar
+from extras.scripts import Script, ObjectVar, BooleanVar, TextVar
+
+from _ip_allocator import FirstFitAllocator
+
+
+# Number of attempts at allocating IPs, when they keep being allocated concurrently by writers not locking the prefix
+ALLOCATION_ATTEMPTS = 3
+
+
+class AllocationRaceError(Exception):
+    """Raised when IPs just allocated turn out to be allocated concurrently by another writer."""
+
+
+def _get_allocator(prefix):
+    """Get a first-fit allocator of the available IPs of a prefix, indexing its child IPs with a single query."""
+    return FirstFitAllocator(
+        prefix.prefix,
+        (address.ip for address in prefix.get_child_ips().values_list("address", flat=True)),
+        reserve_ends=False if prefix.is_pool else None,
+    )
+
+
+def _get_first_ip(prefix, tenant):
+    """Get the first IP of a management prefix which can be allocated to the servers of a tenant.
+
+    Arguments:
+        prefix (ipam.models.Prefix): the management prefix.
+        tenant (tenancy.models.Tenant): the tenant of the devices, or None.
+
+    Returns:
+        ipaddress.IPv4Address, ipaddress.IPv6Address: the first IP.
+
+    """
+    network = ipaddress.ip_network(str(prefix.prefix))
+    # disable 0net skipping on frack
+    if tenant and tenant.slug == 'fr-tech':
+        return network.network_address
+    # skip the first /24 net as this is reserved for network devices
+    return network.network_address + 2 ** (network.max_prefixlen - 24)
+
+
+def _lock_prefixes(prefixes):
+    """Lock the prefixes until the end of the transaction, so that the allocations from each are serialized.
+
+    The rows are locked in a consistent order, to avoid deadlocks between concurrent allocations.
+    """
+    list(
+        Prefix.objects.select_for_update()
+        .filter(pk__in=[prefix.pk for prefix in prefixes])
+        .order_by("pk")
+        .values_list("pk", flat=True)
+    )
+
+
+def _check_allocations(prefix, ips):
+    """Check that the IPs just allocated from the prefix were not allocated concurrently by a writer not locking it.
+
+    Raises:
+        AllocationRaceError: if any of the IPs is allocated more than once.
+
+    """
+    counts = Counter(str(address.ip) for address in prefix.get_child_ips().values_list("address", flat=True))
+    duplicates = [str(ip) for ip in ips if counts[str(ip)] > 1]
+    if duplicates:
+        raise AllocationRaceError(
+            "IPs allocated concurrently on prefix {}: {}".format(prefix.prefix, ", ".join(duplicates))
+        )
+
+
+def _allocate_with_retries(allocate):
+    """Call allocate in a savepoint, rolling it back and retrying when it loses a race, up to ALLOCATION_ATTEMPTS times.
+
+    Raises:
+        AllocationRaceError: if the last attempt loses a race too.
+
+    """
+    for attempt in range(1, ALLOCATION_ATTEMPTS + 1):
+        try:
+            with transaction.atomic():
+                return allocate()
+        except AllocationRaceError:
+            if attempt == ALLOCATION_ATTEMPTS:
+                raise
+
+
+def _notify_created(model, objs):
+    """Send post_save for objects created with bulk_create(), so that their creation is logged as usual."""
+    using = router.db_for_write(model)
+    for obj in objs:
+        post_save.send(sender=model, instance=obj, created=True, raw=False, using=using, update_fields=None)
 
 
 class CreateManagementInterface(Script):
@@ -31,38 +123,34 @@ class CreateManagementInterface(Script):
             self.log_failure(message)
             return message
         self.log_info("Selecting address from network {}".format(prefix.prefix))
-        available_ips = iter(prefix.get_available_ips())
-
-        # disable 0net skipping on frack
-        if device.tenant and device.tenant.slug == 'fr-tech':
-            zeroth_net = None
-        else:
-            # skip the first /24 net as this is reserved for network devices
-            zeroth_net = list(ipaddress.ip_network(prefix.prefix).subnets(new_prefix=24))[0]
-
-        ip = None
-        for ip in available_ips:
-            address = ipaddress.ip_address(ip)
-            if zeroth_net is None or address not in zeroth_net:
-                break
-            else:
-                ip = None
 
-        if ip:
-            # create IP address as child of appropriate prefix
+        def allocate():
+            _lock_prefixes([prefix])
+            ip = _get_allocator(prefix).first_free(_get_first_ip(prefix, device.tenant))
+            if ip is None:
+                return None
+            # create IP address as child of appropriate prefix, assigned to the interface, with a single write
             newip = IPAddress(
                 address="{}/{}".format(ip, prefix.prefix.prefixlen),
                 status=IPADDRESS_STATUS_ACTIVE,
                 family=prefix.family,
+                vrf_id=prefix.vrf_id,
+                tenant=device.tenant,
+                interface=interface,
             )
-            # save ASAP
-            newip.save()
-            newip.vrf = prefix.vrf.pk if prefix.vrf else None
-            # assign ip to interface
-            newip.interface = interface
-            newip.tenant = device.tenant
-            newip.save()
+            IPAddress.objects.bulk_create([newip])
+            _check_allocations(prefix, [ip])
+            return newip
 
+        try:
+            newip = _allocate_with_retries(allocate)
+        except AllocationRaceError as e:
+            message = "Giving up after {} attempts: {}".format(ALLOCATION_ATTEMPTS, e)
+            self.log_failure(message)
+            return message
+
+        if newip:
+            _notify_created(IPAddress, [newip])
             message = "Created ip {} for mgmt on device {}".format(newip, device.name)
             self.log_success(message)
             return message
@@ -91,3 +179,200 @@ class CreateManagementInterface(Script):
             message = "Created mgmt on device {}".format(device.name)
             self.log_success(message)
             return message
+
+
+class CreateManagementInterfaces(Script):
+    class Meta:
+        name = "Create Management Interfaces in batch"
+        description = (
+            "Create a management interface for all the servers of a site, rack or list of devices, "
+            "and assign IP addresses."
+        )
+
+    site = ObjectVar(
+        description="Add management interfaces to the servers of this site", queryset=Site.objects.all(), required=False
+    )
+    rack = ObjectVar(
+        description="Add management interfaces to the servers of this rack", queryset=Rack.objects.all(), required=False
+    )
+    devices = TextVar(description="Add management interfaces to these servers, one name per line", required=False)
+    add_ip = BooleanVar(
+        description="Automatically add IP address from appropriate management network at site.", default=True
+    )
+    dry_run = BooleanVar(description="Only report what would be done, without changing anything.", default=False)
+
+    def _get_devices(self, data):
+        """Get the servers selected by the site, rack and device names, which must all match when several are given."""
+        devices = Device.objects.filter(device_role__slug="server").select_related("site", "tenant").order_by("name")
+        if data["site"]:
+            devices = devices.filter(site=data["site"])
+        if data["rack"]:
+            devices = devices.filter(rack=data["rack"])
+        if data["devices"]:
+            names = {name.strip() for name in data["devices"].splitlines() if name.strip()}
+            devices = list(devices.filter(name__in=names))
+            for name in sorted(names - {device.name for device in devices}):
+                self.log_failure("Can't find server {} in the selection".format(name))
+        return list(devices)
+
+    def _allocate_ips(self, devices, lock=False):
+        """Pick a management IP for each of the devices, computing the available IPs once per management prefix.
+
+        Arguments:
+            devices (list): the devices to pick an IP for.
+            lock (bool, optional): whether to lock the prefixes before computing their available IPs, to serialize the
+                allocations from them until the end of the transaction.
+
+        Returns:
+            collections.OrderedDict: the (prefix, IP) picked, or the failure message, keyed by device pk.
+
+        """
+        groups = OrderedDict()
+        for device in devices:
+            groups.setdefault((device.site_id, device.tenant_id), []).append(device)
+
+        prefixes = {}
+        for prefix in Prefix.objects.filter(role__slug="management", site_id__in={site_id for site_id, _ in groups}):
+            prefixes.setdefault((prefix.site_id, prefix.tenant_id), []).append(prefix)
+        if lock:
+            _lock_prefixes([candidates[0] for candidates in prefixes.values() if len(candidates) == 1])
+
+        allocations = OrderedDict()
+        for key, group in groups.items():
+            site = group[0].site
+            candidates = prefixes.get(key, [])
+            if len(candidates) != 1:
+                for device in group:
+                    allocations[device.pk] = "Can't find {} prefix for site {} on device {}".format(
+                        "a single" if candidates else "a", site.slug, device.name
+                    )
+                continue
+
+            prefix = candidates[0]
+            self.log_info("Selecting addresses from network {} for {} servers".format(prefix.prefix, len(group)))
+            allocator = _get_allocator(prefix)
+            first_ip = _get_first_ip(prefix, group[0].tenant)
+            for device in group:
+                ip = allocator.allocate(first_ip)
+                if ip is None:
+                    allocations[device.pk] = "Not enough IPs to allocate one on prefix {} for device {}".format(
+                        prefix.prefix, device.name
+                    )
+                else:
+                    allocations[device.pk] = (prefix, ip)
+
+        return allocations
+
+    def _create_ips(self, devices, interfaces, dry_run):
+        """Allocate and create a management IP for each of the devices, assigned to its mgmt interface.
+
+        Unless in dry run, the prefixes are locked before allocating the IPs, and the IPs are created fully populated
+        with a single bulk insert.
+
+        Arguments:
+            devices (list): the devices to create an IP for.
+            interfaces (dict): the mgmt interfaces keyed by device pk.
+            dry_run (bool): whether to only allocate the IPs, without locking the prefixes nor creating the IPs.
+
+        Returns:
+            collections.OrderedDict: the new ipam.models.IPAddress, or the failure message, keyed by device pk.
+
+        Raises:
+            AllocationRaceError: if some IPs were allocated concurrently by a writer not locking the prefixes.
+
+        """
+        tenants = {device.pk: device.tenant for device in devices}
+        ips = OrderedDict()
+        allocated = OrderedDict()
+        for device_id, allocation in self._allocate_ips(devices, lock=not dry_run).items():
+            if isinstance(allocation, str):
+                ips[device_id] = allocation
+                continue
+
+            prefix, ip = allocation
+            ips[device_id] = IPAddress(
+                address="{}/{}".format(ip, prefix.prefix.prefixlen),
+                status=IPADDRESS_STATUS_ACTIVE,
+                family=prefix.family,
+                vrf_id=prefix.vrf_id,
+                tenant=tenants[device_id],
+                interface=interfaces[device_id],
+            )
+            allocated.setdefault(prefix.pk, (prefix, []))[1].append(ip)
+
+        if not dry_run:
+            IPAddress.objects.bulk_create([ip for ip in ips.values() if not isinstance(ip, str)])
+            for prefix, prefix_ips in allocated.values():
+                _check_allocations(prefix, prefix_ips)
+
+        return ips
+
+    def run(self, data):
+        """Create a 'mgmt' interface on each selected server and, if requested, allocate an appropriate IP address.
+
+        The interfaces and IP addresses are all created with bulk inserts, in a single transaction, holding a lock on
+        the prefixes the IPs are allocated from, so that several batches can run concurrently.
+        """
+        if not (data["site"] or data["rack"] or data["devices"]):
+            message = "Select a site, a rack or a list of devices"
+            self.log_failure(message)
+            return message
+
+        dry_run = data["dry_run"]
+        devices = self._get_devices(data)
+        interfaces = {
+            interface.device_id: interface
+            for interface in Interface.objects.filter(device__in=devices, name="mgmt").prefetch_related("ip_addresses")
+        }
+
+        results = OrderedDict((device.pk, []) for device in devices)
+        new_interfaces = []
+        for device in devices:
+            if device.pk in interfaces:
+                results[device.pk].append("mgmt already exists")
+            else:
+                interfaces[device.pk] = Interface(name="mgmt", mgmt_only=True, device=device, type=IFACE_TYPE_1GE_FIXED)
+                new_interfaces.append(interfaces[device.pk])
+                results[device.pk].append("created mgmt")
+
+        ip_devices = []
+        if data["add_ip"]:
+            for device in devices:
+                if interfaces[device.pk].pk and interfaces[device.pk].ip_addresses.all():
+                    results[device.pk].append("mgmt already has an IP")
+                else:
+                    ip_devices.append(device)
+
+        failures = set()
+        with transaction.atomic():
+            if not dry_run:
+                Interface.objects.bulk_create(new_interfaces)
+            try:
+                ips = _allocate_with_retries(lambda: self._create_ips(ip_devices, interfaces, dry_run))
+            except AllocationRaceError as e:
+                ips = {}
+                for device in ip_devices:
+                    failures.add(device.pk)
+                    results[device.pk].append("giving up after {} attempts: {}".format(ALLOCATION_ATTEMPTS, e))
+
+        if not dry_run:
+            _notify_created(Interface, new_interfaces)
+            _notify_created(IPAddress, [ip for ip in ips.values() if not isinstance(ip, str)])
+
+        for device_id, ip in ips.items():
+            if isinstance(ip, str):
+                failures.add(device_id)
+                results[device_id].append(ip)
+            else:
+                results[device_id].append("created ip {}".format(ip.address))
+
+        prefix = "[dry run] " if dry_run else ""
+        lines = []
+        for device in devices:
+            message = "{}{}: {}".format(prefix, device.name, ", ".join(results[device.pk]))
+            if device.pk in failures:
+                self.log_failure(message)
+            else:
+                self.log_success(message)
+            lines.append(message)
+        return "\n".join(lines)
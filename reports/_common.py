@@ -0,0 +1,593 @@
+"""
+Helpers shared by several reports.
+
+This is not a report itself. Netbox loads every file of the reports directory to list the reports, but loads only the
+file of a report to run or show it, without putting the directory on sys.path: each report adds it before importing
+from here, so that this is a regular module, imported once per process whatever the report loaded first. Listing the
+reports executes it again, in that same module object. The mixins below don't subclass Report, otherwise Netbox
+would list them as reports in every module importing them.
+"""
+
+import atexit
+import configparser
+import datetime
+import hashlib
+import json
+import os
+import re
+import multiprocessing
+import sqlite3
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, connections
+from django.db.models import Count, Max, Q
+from django.utils import timezone
+
+from dcim.constants import CONNECTION_STATUS_CONNECTED
+from dcim.models import ConsolePort
+from extras.models import CustomField, CustomFieldValue
+
+
+CONFIG_FILE = "/etc/netbox/reports.cfg"
+
+# Defaults for the incremental runs, can be overridden with the enabled, store, full_run_interval (in hours) and lag
+# (in seconds) keys in the incremental section of the config file. The lag is subtracted from the start of the previous
+# run, to also pick up the objects whose changes were committed after it read them.
+INCREMENTAL_STORE = "/tmp/netbox_reports_incremental.sqlite"
+FULL_RUN_INTERVAL = 24
+SINCE_LAG = 300
+# Set this environment variable to a non-empty value to force a full run of the incremental reports
+FULL_RUN_ENV = "NETBOX_REPORTS_FULL_RUN"
+
+# Defaults for running the tests of a report concurrently, can be overridden with the mode (one of PARALLEL_MODES) and
+# workers keys in the parallel section of the config file.
+PARALLEL_MODES = ("serial", "thread", "process")
+PARALLEL_WORKERS = 4
+
+# The objects shared by all the runs of the reports in the process, see process_singleton(). Listing the reports
+# executes this module again in the same module object, which keeps them.
+_PROCESS_SINGLETONS = globals().get("_PROCESS_SINGLETONS", {})
+_PROCESS_SINGLETONS_LOCK = globals().get("_PROCESS_SINGLETONS_LOCK") or threading.Lock()
+
+# Number of most repeated query shapes reported by InstrumentationMixin, and their maximum length
+TOP_QUERY_SHAPES = 3
+QUERY_SHAPE_LENGTH = 200
+# Placeholder lists of IN clauses, whose length varies with the parameters
+IN_PLACEHOLDERS_RE = re.compile(r"\(\s*%s(?:\s*,\s*%s)*\s*\)")
+
+
+class TestStats:
+    """Database statistics of a single test, collected through a Django execute wrapper.
+
+    The wrapper sees the SQL before parameter interpolation, so the SQL is already the shape of the query, apart from
+    the variable number of placeholders of IN clauses which are collapsed. Unlike connection.queries, this does not
+    need DEBUG to be enabled.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.shapes = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            self.shapes[sql] += 1
+
+    def top_shapes(self):
+        """Get the most repeated query shapes, as (count, shape) tuples."""
+        shapes = Counter()
+        for sql, count in self.shapes.items():
+            shapes[IN_PLACEHOLDERS_RE.sub("(%s, ...)", sql)] += count
+        return [
+            (count, shape[:QUERY_SHAPE_LENGTH]) for shape, count in shapes.most_common(TOP_QUERY_SHAPES) if count > 1
+        ]
+
+
+class InstrumentationMixin:
+    """Report mixin logging, at the end of each test, its elapsed time and database statistics.
+
+    The summary includes the number of queries, the time spent in the database and the most repeated query shapes,
+    which is how N+1 query patterns show up. To opt in, list it before Report in the bases of a report class.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        # shadow the test methods with their instrumented version, which is what Report.run() will then call
+        for method_name in self.test_methods:
+            setattr(self, method_name, self._instrument(getattr(self, method_name)))
+
+    def _instrument(self, test_method):
+        @wraps(test_method)
+        def instrumented():
+            stats = TestStats()
+            start = time.perf_counter()
+            try:
+                with connection.execute_wrapper(stats):
+                    return test_method()
+            finally:
+                self._log_test_stats(time.perf_counter() - start, stats)
+
+        return instrumented
+
+    def _log_test_stats(self, elapsed, stats):
+        message = "{:.2f}s, {} queries ({:.2f}s in database)".format(elapsed, stats.queries, stats.db_time)
+        top_shapes = stats.top_shapes()
+        if top_shapes:
+            message += "; most repeated queries: {}".format(
+                "; ".join("{}x {}".format(count, shape) for count, shape in top_shapes)
+            )
+        self.log_info(None, message)
+
+
+class ParallelMixin:
+    """Report mixin running the tests of a report concurrently, in a thread or process pool, when configured to.
+
+    The mode and the number of workers are read from the parallel section of the config file, serial by default. The
+    first test runs on its own, so that the shared data is loaded and logged as in a serial run, and each test logs in
+    its own result entry, in test order. In process mode, the workers are forked once the datasets listed in preload
+    are loaded, and it is refused for the reports which list none. List this first in the bases of a report class,
+    with thread safe lazy loading, for example through a DataProvider.
+    """
+
+    preload = ()  # the "provider.dataset" names of the datasets to load before forking the workers in process mode
+    _forked_report = None  # the report run by the forked workers, set in the parent before forking
+
+    @property
+    def active_test(self):
+        """The test being run by the current thread, which is where the log_* methods log."""
+        return getattr(self._active_tests, "name", None)
+
+    @active_test.setter
+    def active_test(self, name):
+        if "_active_tests" not in self.__dict__:
+            self._active_tests = threading.local()
+        self._active_tests.name = name
+
+    def run(self):
+        """Run the tests with the configured concurrency, then record the results as Report.run() does."""
+        config = configparser.ConfigParser()
+        config.read(CONFIG_FILE)
+        mode = config.get("parallel", "mode", fallback="serial")
+        workers = config.getint("parallel", "workers", fallback=PARALLEL_WORKERS)
+        if mode not in PARALLEL_MODES:
+            raise ValueError("Invalid parallel mode {}, expected one of: {}".format(mode, ", ".join(PARALLEL_MODES)))
+
+        if mode == "serial" or workers < 2 or len(self.test_methods) < 2:
+            return super().run()
+        if mode == "process" and not self.preload:
+            raise ValueError("Report {} declares no preload, it can't run in process mode".format(self.name))
+
+        first, *others = self.test_methods
+        self._run_test(first)
+        if mode == "thread":
+            self._run_threads(others, workers)
+        else:
+            self._preload()
+            self._run_processes(others, workers)
+
+        # All the tests have run, let Report.run() record the results and run the post-run tasks
+        test_methods, self.test_methods = self.test_methods, []
+        try:
+            return super().run()
+        finally:
+            self.test_methods = test_methods
+
+    def _run_test(self, method_name):
+        self.active_test = method_name
+        getattr(self, method_name)()
+
+    def _preload(self):
+        # Still in the first test, where the load times are logged
+        for dataset in self.preload:
+            provider, name = dataset.split(".")
+            try:
+                getattr(getattr(self, provider), name)
+            except Exception:
+                pass  # the DataProvider remembers the error, the tests using the dataset fail as in a serial run
+
+    def _run_threads(self, method_names, workers):
+        def run_test(method_name):
+            try:
+                self._run_test(method_name)
+            finally:
+                connections.close_all()  # only closes the connections of this thread
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() yields in order: the first exception is raised once all the tests have completed
+            for _ in executor.map(run_test, method_names):
+                pass
+
+    def _run_processes(self, method_names, workers):
+        # The forked workers must not share the connections of the parent, they open their own
+        connections.close_all()
+        ParallelMixin._forked_report = self
+        try:
+            with multiprocessing.get_context("fork").Pool(workers) as pool:
+                for method_name, (results, failed) in zip(method_names, pool.map(_run_forked_test, method_names)):
+                    self._results[method_name] = results
+                    self.failed = self.failed or failed
+        finally:
+            ParallelMixin._forked_report = None
+
+
+def _run_forked_test(method_name):
+    """Run a test of the report being run by ParallelMixin in a forked worker, and return its results."""
+    report = ParallelMixin._forked_report
+    try:
+        report._run_test(method_name)
+    finally:
+        connections.close_all()
+    return report._results[method_name], report.failed
+
+
+class DataProvider:
+    """Lazy loader of the external datasets of a report.
+
+    Each dataset is registered with a loader callable and is loaded the first time it is accessed as an attribute, to
+    be reused by all the following tests of the same run. Errors are remembered too, so that an unavailable source is
+    not retried by every test. Netbox instantiates all the reports just to list them, so nothing is loaded here.
+    """
+
+    def __init__(self, on_load=None, **loaders):
+        """Register the dataset loaders.
+
+        Arguments:
+            on_load (callable, optional): called with the dataset name and the seconds it took to load, after each
+                load.
+            **loaders (callable): the loader of each dataset, keyed by the dataset name.
+
+        """
+        self._on_load = on_load
+        self._loaders = loaders
+        self._errors = {}
+        self._lock = threading.RLock()
+        self.load_times = OrderedDict()
+
+    def __getattr__(self, name):
+        """Load the dataset on first access, and store it as an attribute to skip this method on the next ones."""
+        try:
+            loader = self.__dict__["_loaders"][name]
+        except KeyError:
+            raise AttributeError(name)
+
+        # Tests running concurrently wait for the first one to load the dataset instead of loading it again
+        with self._lock:
+            if name in self.__dict__:
+                return self.__dict__[name]
+            if name in self._errors:
+                raise self._errors[name]
+
+            start = time.monotonic()
+            try:
+                value = loader()
+            except Exception as e:
+                self._errors[name] = e
+                raise
+            finally:
+                self.load_times[name] = time.monotonic() - start
+
+            setattr(self, name, value)
+        if self._on_load is not None:
+            self._on_load(name, self.load_times[name])
+        return value
+
+
+def log_load_time(report):
+    """Get a DataProvider on_load callback logging the load times in the current test of the given report."""
+
+    def on_load(name, seconds):
+        report.log_info(None, "loaded {} in {:.2f}s".format(name, seconds))
+
+    return on_load
+
+
+class CustomFieldIndex:
+    """Run-wide index of the values of some custom fields of a model, keyed by field name and object pk.
+
+    The values are loaded with a single query and kept in one dict per field, only for the requested fields and
+    only for the objects that have a value, so that memory stays bounded by what the report actually uses.
+
+    Be warned that this treats empty values as non-existing fields.
+    """
+
+    def __init__(self, model, fields, queryset=None):
+        """Load the values of the given custom fields.
+
+        Arguments:
+            model (django.db.models.Model): the model the custom fields are attached to.
+            fields (iterable): the names of the custom fields to load.
+            queryset (django.db.models.QuerySet, optional): restrict the index to the objects in this queryset.
+
+        """
+        self._values = {name: {} for name in fields}
+        custom_fields = {field.pk: field for field in CustomField.objects.filter(name__in=self._values.keys())}
+
+        values = CustomFieldValue.objects.filter(
+            obj_type=ContentType.objects.get_for_model(model), field_id__in=custom_fields.keys()
+        )
+        if queryset is not None:
+            values = values.filter(obj_id__in=queryset.values("pk"))
+
+        for obj_id, field_id, serialized_value in values.values_list(
+            "obj_id", "field_id", "serialized_value"
+        ).iterator():
+            field = custom_fields[field_id]
+            value = field.deserialize_value(serialized_value)
+            if value is not None:
+                self._values[field.name][obj_id] = value
+
+    def get(self, obj, field):
+        """Get the value for the specified custom field name of an object, or None if missing or empty."""
+        return self._values[field].get(obj.pk)
+
+
+class ConsolePortIndex:
+    """Run-wide index of how many console ports each device has, and how many of them are connected.
+
+    The counts are loaded with a single aggregate query, so that the number of queries does not depend on the number
+    of devices.
+    """
+
+    def __init__(self, devices=None):
+        """Load the console port counts.
+
+        Arguments:
+            devices (django.db.models.QuerySet, optional): restrict the index to the devices in this queryset.
+
+        """
+        self._ports = ConsolePort.objects.all()
+        if devices is not None:
+            self._ports = self._ports.filter(device_id__in=devices.values("pk"))
+
+        self._counts = {
+            device_id: (total, connected)
+            for device_id, total, connected in self._ports.values("device_id")
+            .annotate(total=Count("pk"), connected=Count("pk", filter=Q(connection_status=CONNECTION_STATUS_CONNECTED)))
+            .values_list("device_id", "total", "connected")
+            .order_by()
+        }
+
+    def total(self, device):
+        """Get the number of console ports of a device."""
+        return self._counts.get(device.pk, (0, 0))[0]
+
+    def connected(self, device):
+        """Get the number of connected console ports of a device."""
+        return self._counts.get(device.pk, (0, 0))[1]
+
+    def connected_names(self, devices):
+        """Get the names of the connected console ports of the given devices, with a single query.
+
+        Arguments:
+            devices (iterable): the devices to get the connected console port names of.
+
+        Returns:
+            dict: a list of console port names keyed by device pk.
+
+        """
+        names = defaultdict(list)
+        device_ids = [device.pk for device in devices if self.connected(device)]
+        if not device_ids:
+            return names
+
+        for device_id, name in self._ports.filter(
+            device_id__in=device_ids, connection_status=CONNECTION_STATUS_CONNECTED
+        ).values_list("device_id", "name"):
+            names[device_id].append(name)
+        return names
+
+
+def models_fingerprint(*models):
+    """Get a cheap fingerprint of the contents of the given change-logged models, from their count and last update."""
+    fingerprint = []
+    for model in models:
+        stats = model.objects.aggregate(count=Count("pk"), last_updated=Max("last_updated"))
+        fingerprint.append([stats["count"], stats["last_updated"] and stats["last_updated"].timestamp()])
+    return fingerprint
+
+
+def _get_incremental_config():
+    """Get the incremental section of the config file, empty if missing."""
+    config = configparser.ConfigParser()
+    config.read(CONFIG_FILE)
+    if not config.has_section("incremental"):
+        config.add_section("incremental")
+    return config["incremental"]
+
+
+class ResultStore:
+    """Per-object results of a report, carried forward between runs to only re-check the objects that changed.
+
+    The results are kept in a SQLite database, as one JSON value per object. A run is incremental only when enabled
+    in the config file, when the previous full run is recent enough, when no full run was requested through the
+    environment, and when the fingerprint is the same as in the previous run. The fingerprint must cover everything
+    the results depend on besides the objects themselves; the source of the report module is always part of it.
+    """
+
+    def __init__(self, name, module_file, fingerprint):
+        """Open the store and decide whether this run can be incremental.
+
+        Arguments:
+            name (str): the name of the result set, usually the report name.
+            module_file (str): the path of the report module, whose changes invalidate the results.
+            fingerprint (list): a JSON serializable fingerprint of what the results depend on.
+
+        """
+        config = _get_incremental_config()
+
+        self.name = name
+        self.started = timezone.now()
+        self.since = None
+        self._connection = None
+        if not config.getboolean("enabled", fallback=False):
+            return
+
+        with open(module_file, "rb") as f:
+            fingerprint = [hashlib.sha1(f.read()).hexdigest(), fingerprint]
+        self._fingerprint = json.dumps(fingerprint)
+
+        self._connection = sqlite3.connect(config.get("store", INCREMENTAL_STORE))
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS runs "
+                "(name TEXT PRIMARY KEY, last_run REAL, last_full_run REAL, fingerprint TEXT)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results "
+                "(name TEXT, obj_id INTEGER, result TEXT, PRIMARY KEY (name, obj_id))"
+            )
+        row = self._connection.execute(
+            "SELECT last_run, last_full_run, fingerprint FROM runs WHERE name = ?", (name,)
+        ).fetchone()
+        if row is None or os.environ.get(FULL_RUN_ENV) or row[2] != self._fingerprint:
+            return
+
+        full_run_interval = config.getfloat("full_run_interval", fallback=FULL_RUN_INTERVAL) * 3600
+        if self.started.timestamp() - row[1] < full_run_interval:
+            lag = config.getfloat("lag", fallback=SINCE_LAG)
+            self.since = datetime.datetime.fromtimestamp(row[0] - lag, tz=datetime.timezone.utc)
+            self._last_full_run = row[1]
+
+    @property
+    def incremental(self):
+        """Whether this run is incremental, i.e. only the objects updated since the last run need to be checked."""
+        return self.since is not None
+
+    def load(self):
+        """Load the results of the previous run.
+
+        Returns:
+            dict: the results keyed by object id, empty if this run is not incremental.
+
+        """
+        if not self.incremental:
+            return {}
+        return {
+            obj_id: json.loads(result)
+            for obj_id, result in self._connection.execute(
+                "SELECT obj_id, result FROM results WHERE name = ?", (self.name,)
+            )
+        }
+
+    def save(self, updated, removed=()):
+        """Save the results of this run, and mark it as the last run.
+
+        Arguments:
+            updated (dict): the JSON serializable results of the checked objects, keyed by object id. On a full run,
+                these replace all the stored results.
+            removed (iterable): the ids of the objects that no longer exist.
+
+        """
+        if self._connection is None:
+            return
+
+        last_full_run = self._last_full_run if self.incremental else self.started.timestamp()
+        with self._connection:
+            if not self.incremental:
+                self._connection.execute("DELETE FROM results WHERE name = ?", (self.name,))
+            self._connection.executemany(
+                "DELETE FROM results WHERE name = ? AND obj_id = ?", ((self.name, obj_id) for obj_id in removed)
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (name, obj_id, result) VALUES (?, ?, ?)",
+                ((self.name, obj_id, json.dumps(result)) for obj_id, result in updated.items()),
+            )
+            self._connection.execute(
+                "INSERT OR REPLACE INTO runs (name, last_run, last_full_run, fingerprint) VALUES (?, ?, ?, ?)",
+                (self.name, self.started.timestamp(), last_full_run, self._fingerprint),
+            )
+        self._connection.close()
+        self._connection = None
+
+
+class RegexMemo:
+    """Memo of whether names match a regular expression, to evaluate it once per distinct name.
+
+    When the incremental runs are enabled, the memo is persisted across runs in the same store, keyed by the pattern,
+    so that only the names never seen before are evaluated. The whole memo of a pattern is loaded in memory, which is
+    fine for names that repeat heavily, like interface names.
+    """
+
+    def __init__(self, regex):
+        """Load the persisted memo of the regular expression, if any.
+
+        Arguments:
+            regex: A pre-compiled regular expression object, to be used with its match() method.
+
+        """
+        self._regex = regex
+        self._matches = {}
+        self._new = {}
+        self._seen = set()
+        self._connection = None
+
+        config = _get_incremental_config()
+        if not config.getboolean("enabled", fallback=False):
+            return
+
+        self._connection = sqlite3.connect(config.get("store", INCREMENTAL_STORE))
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS regex_memo "
+                "(pattern TEXT, name TEXT, matches INTEGER, PRIMARY KEY (pattern, name))"
+            )
+        self._matches.update(
+            (name, bool(matches))
+            for name, matches in self._connection.execute(
+                "SELECT name, matches FROM regex_memo WHERE pattern = ?", (regex.pattern,)
+            )
+        )
+
+    def match(self, name):
+        """Get whether the name matches the regular expression, evaluating it only for names not memoized yet."""
+        self._seen.add(name)
+        try:
+            return self._matches[name]
+        except KeyError:
+            matches = self._matches[name] = self._new[name] = bool(self._regex.match(name))
+            return matches
+
+    def save(self):
+        """Persist the memo, forgetting the names which were not matched since it was loaded."""
+        if self._connection is None:
+            return
+
+        pattern = self._regex.pattern
+        with self._connection:
+            self._connection.executemany(
+                "DELETE FROM regex_memo WHERE pattern = ? AND name = ?",
+                ((pattern, name) for name in self._matches.keys() - self._seen),
+            )
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO regex_memo (pattern, name, matches) VALUES (?, ?, ?)",
+                ((pattern, name, matches) for name, matches in self._new.items()),
+            )
+        self._connection.close()
+        self._connection = None
+
+
+def process_singleton(name, factory):
+    """Get the object shared under the given name by all the runs of the reports in this process.
+
+    The object is created with factory() on first use, and its close() method, if any, is registered to be called at
+    exit. Unlike the globals of the report modules, which Netbox may load again into a new module object, it is kept
+    for the life of the process.
+    """
+    with _PROCESS_SINGLETONS_LOCK:
+        if name not in _PROCESS_SINGLETONS:
+            instance = factory()
+            if hasattr(instance, "close"):
+                atexit.register(instance.close)
+            _PROCESS_SINGLETONS[name] = instance
+        return _PROCESS_SINGLETONS[name]
@@ -7,6 +7,10 @@ Requires google-api-python-client and google-auth-oauthlib.
 """
 
 import configparser
+import json
+import os
+import sys
+import time
 from collections import OrderedDict
 from datetime import date, datetime, timedelta
 
@@ -16,44 +20,139 @@ from extras.reports import Report
 import googleapiclient.discovery
 from google.oauth2 import service_account
 
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import CustomFieldIndex, DataProvider, InstrumentationMixin, ParallelMixin, log_load_time  # noqa: E402
+
 CONFIG_FILE = "/etc/netbox/gsheets.cfg"
 
+# Defaults for the cache of the parsed assets, can be overridden with the cache_file and cache_ttl (in seconds) keys
+# in the accounting section of the config file.
+CACHE_FILE = "/tmp/accounting_assets.json"
+CACHE_TTL = 3600
+
+SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    # to check the version of the spreadsheet
+    "https://www.googleapis.com/auth/drive.metadata.readonly",
+]
+
 
-class Accounting(Report):
+class Accounting(ParallelMixin, InstrumentationMixin, Report):
     description = """
     Checks the consistency of Netbox data against the Data Center Equipment
     Asset Tags spreadsheet.
     """
+    preload = ("sources.assets",)
 
     def __init__(self, *args, **kwargs):
-        """Loads the config file and initializes the Google Sheets API."""
+        """Loads the config file and sets up the lazy loading of the assets."""
         config = configparser.ConfigParser(interpolation=None)
         config.read(CONFIG_FILE)
 
-        self.assets = self.get_assets_from_accounting(
-            config["service-credentials"], config["accounting"]["sheet_id"], config["accounting"]["range"]
-        )
+        self.sources = DataProvider(on_load=log_load_time(self), assets=lambda: self.load_assets(config))
 
         super().__init__(*args, **kwargs)
 
+    @property
+    def assets(self):
+        """The assets keyed by serial number, loaded on first access."""
+        return self.sources.assets
+
+    @classmethod
+    def load_assets(cls, config, sheets=None, drive=None):
+        """Loads the assets, using the on-disk cache of the parsed assets whenever possible.
+
+        The cache is used as is while younger than its TTL. Once expired, it is revalidated against the version of
+        the spreadsheet, and the spreadsheet is only downloaded and parsed again if it has changed. In offline mode
+        the cache is always used, regardless of its age.
+
+        Arguments:
+            config (configparser.ConfigParser): the report configuration.
+            sheets: the Google Sheets API resource to use, built from the service credentials if not given.
+            drive: the Google Drive API resource to use, built from the service credentials if not given.
+
+        Returns:
+            collections.OrderedDict: the assets keyed by serial number.
+
+        Raises:
+            Exception: in offline mode, if there is no usable cache.
+
+        """
+        accounting = config["accounting"]
+        sheet_id = accounting["sheet_id"]
+        range = accounting["range"]
+        cache_file = accounting.get("cache_file", CACHE_FILE)
+
+        cache = cls._read_cache(cache_file, sheet_id, range)
+        if accounting.getboolean("offline", fallback=False):
+            if cache is None:
+                raise Exception("Running offline but no cached assets found in {}".format(cache_file))
+            return cache["assets"]
+
+        if cache is not None and time.time() - cache["checked"] < accounting.getint("cache_ttl", fallback=CACHE_TTL):
+            return cache["assets"]
+
+        if sheets is None or drive is None:
+            creds = service_account.Credentials.from_service_account_info(config["service-credentials"], scopes=SCOPES)
+            if sheets is None:
+                sheets = googleapiclient.discovery.build("sheets", "v4", credentials=creds)
+            if drive is None:
+                drive = googleapiclient.discovery.build("drive", "v3", credentials=creds)
+
+        version = drive.files().get(fileId=sheet_id, fields="version", supportsAllDrives=True).execute()["version"]
+        if cache is not None and cache["version"] == version:
+            assets = cache["assets"]
+        else:
+            assets = cls.get_assets_from_accounting(sheets, sheet_id, range)
+
+        cls._write_cache(cache_file, sheet_id, range, version, assets)
+        return assets
+
     @staticmethod
-    def get_assets_from_accounting(creds, sheet_id, range):
-        """Retrieves all assets from a specified Google Spreadsheet."""
+    def _read_cache(cache_file, sheet_id, range):
+        """Reads the cached assets, returning None if missing, unreadable or for another sheet or range."""
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f, object_pairs_hook=OrderedDict)
 
-        # initialize the credentials API
-        creds = service_account.Credentials.from_service_account_info(
-            creds, scopes=["https://www.googleapis.com/auth/spreadsheets.readonly"]
+            if cache["sheet_id"] != sheet_id or cache["range"] != range:
+                return None
+
+            for asset in cache["assets"].values():
+                asset["date"] = datetime.strptime(asset["date"], "%Y-%m-%d").date()
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+        return cache
+
+    @staticmethod
+    def _write_cache(cache_file, sheet_id, range, version, assets):
+        """Atomically writes the assets to the cache, along with the sheet version they were parsed from."""
+        cache = OrderedDict(
+            (
+                ("sheet_id", sheet_id),
+                ("range", range),
+                ("version", version),
+                ("checked", time.time()),
+                ("assets", assets),
+            )
         )
+        tmp_file = "{}.tmp".format(cache_file)
+        with open(tmp_file, "w") as f:
+            json.dump(cache, f, default=date.isoformat)
+        os.replace(tmp_file, cache_file)
 
-        # initialize the Sheets API
-        service = googleapiclient.discovery.build("sheets", "v4", credentials=creds)
-        sheet = service.spreadsheets()
+    @staticmethod
+    def get_assets_from_accounting(sheets, sheet_id, range):
+        """Retrieves and parses all assets from a specified Google Spreadsheet."""
 
-        # and fetch the spreadsheet's contents
-        result = sheet.values().get(spreadsheetId=sheet_id, range=range).execute()
+        # fetch the spreadsheet's contents
+        result = sheets.spreadsheets().values().get(spreadsheetId=sheet_id, range=range).execute()
         values = result.get("values", [])
         if not values:
-            return values
+            return OrderedDict()
 
         # ignore the first row, as it is the document header; the second row is
         # the header row, with column names, which we map here to our own names
@@ -117,9 +216,9 @@ class Accounting(Report):
 
         devices = {}
         qs = Device.objects.filter(serial__in=self.assets.keys())
-        qs = qs.prefetch_related("custom_field_values__field")
         for device in qs:
             devices[device.serial] = device
+        custom_fields = CustomFieldIndex(Device, ("ticket",), queryset=qs)
 
         asset_tag_matches = ticket_matches = 0
         for serial, asset in self.assets.items():
@@ -148,17 +247,7 @@ class Accounting(Report):
             else:
                 asset_tag_matches += 1
 
-            # this is a rather convoluted way of fetching a custom field: this
-            # is the equivalent of device.cf()["ticket"]. However, this way,
-            # combined with the prefetch_related of custom_field_values__field
-            # above, eliminates hundreds of queries and, consequently, makes
-            # this 10-20x faster. There is likely a shorter way to do this, I
-            # just haven't found it yet.
-            netbox_ticket = None
-            for cfv in device.custom_field_values.all():
-                if cfv.field.name == "ticket":
-                    netbox_ticket = cfv.value
-                    break
+            netbox_ticket = custom_fields.get(device, "ticket")
 
             if ticket != netbox_ticket:
                 self.log_warning(
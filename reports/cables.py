@@ -5,9 +5,15 @@ BLACKLISTS:
   test_blank_cable_label: eqiad
 """
 
+import os
 import re
+import sys
 
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, namedtuple
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.db.models import Count, OuterRef, Subquery
 
 from dcim.constants import (
     DEVICE_STATUS_DECOMMISSIONING,
@@ -15,9 +21,32 @@ from dcim.constants import (
     DEVICE_STATUS_OFFLINE,
     DEVICE_STATUS_PLANNED,
 )
-from dcim.models import Cable, ConsolePort, ConsoleServerPort, Interface, PowerPort, PowerOutlet
+from circuits.models import CircuitTermination
+from dcim.models import (
+    Cable,
+    ConsolePort,
+    ConsoleServerPort,
+    FrontPort,
+    Interface,
+    PowerPort,
+    PowerOutlet,
+    RearPort,
+    Site,
+)
 from extras.reports import Report
 
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import (  # noqa: E402
+    DataProvider,
+    InstrumentationMixin,
+    ParallelMixin,
+    RegexMemo,
+    ResultStore,
+    models_fingerprint,
+)
+
 # these are statuses for devices that we care about
 EXCLUDE_STATUSES = (
     DEVICE_STATUS_DECOMMISSIONING,
@@ -39,27 +68,96 @@ INTERFACES_REGEXP = (
 
 BLANK_CABLES_SITE_BLACKLIST = ('eqiad',)
 
+# The databases whose regex lookup understands the Python syntax used in the regexps above: the advanced regular
+# expressions of PostgreSQL, and SQLite where Django implements it with the re module.
+DB_REGEX_VENDORS = ("postgresql", "sqlite")
+# The Python regex syntax which means the same in the advanced regular expressions of PostgreSQL, as a whole pattern
+# made of: escaped punctuation, the \d, \s and \w classes and the control character escapes, capturing and (?:
+# groups, bounded repetitions, and bracket expressions without POSIX classes, besides the plain characters and
+# operators. Anything else, e.g. the \b or \Z escapes, lookarounds, named groups or inline flags, makes the names be
+# matched in Python instead. The remaining differences, for $ and . around newlines, don't matter for port names.
+DB_REGEX_SYNTAX_RE = re.compile(
+    r"""(?:
+        \\[^0-9A-Za-z] | \\[dDsSwWfnrtv]
+        | \((?!\?) | \(\?:
+        | \{\d+(?:,\d*)?\}
+        | \[\^?\]?(?:[^]\\[]|\\[^0-9A-Za-z]|\\[dswfnrtv])*\]
+        | [^\\[{(]
+    )*""",
+    re.VERBOSE,
+)
+
+# The cable termination models attached to a device
+DEVICE_TERMINATIONS = (ConsolePort, ConsoleServerPort, FrontPort, Interface, PowerOutlet, PowerPort, RearPort)
+
+# What the label tests need to know about a cable: its label, status, whether both its ends are terminated and its
+# representative site slug
+CableFacts = namedtuple("CableFacts", ("label", "status", "terminated", "site"))
+
+
+def _get_db_regex(regex, vendor):
+    """Translate a compiled Python regular expression for matching with the regex lookup of the given database.
+
+    Arguments:
+        regex: A pre-compiled regular expression object, to be used with its match() method.
+        vendor: The vendor of the database connection, e.g. "postgresql".
 
-class Cables(Report):
+    Returns:
+        str: The regular expression to use with the regex lookup, anchored like match() does, or None if the database
+        dialect can't express it.
+
+    """
+    if vendor not in DB_REGEX_VENDORS or regex.flags & ~re.UNICODE or not DB_REGEX_SYNTAX_RE.fullmatch(regex.pattern):
+        return None
+    return r"^(?:{})".format(regex.pattern)
+
+
+class Cables(ParallelMixin, InstrumentationMixin, Report):
     """Report on various cable-related errors."""
 
     description = __doc__
+    preload = ("_data.cable_facts",)
+
+    def __init__(self, *args, **kwargs):
+        self._data = DataProvider(cable_facts=self._get_cable_facts)
+
+        super().__init__(*args, **kwargs)
 
-    def _port_names_test(self, queryset, regex, label):
+    def _port_names_test(self, queryset, regex, label, memo=None):
         """Test and report each item in the query set (presumed to be a CableTermination) for its name matching the
         compiled regular expression passed as regex.
 
+        The names are matched in the database when its regular expression dialect can express the pattern, so that
+        only the failing items are fetched. Otherwise, or when a memo is given, the regular expression is evaluated in
+        Python once per distinct name instead, and only the items with failing names are fetched.
+
         Arguments:
             queryset: A pre-filtered queryset of a CableTermination child.
             regex: A pre-compiled regular expression object to match the cable names against.
             label: A label to identify the cables with in log messages.
+            memo: An optional _common.RegexMemo of the regex, to evaluate it once per distinct name across runs.
         """
-        successes = 0
-        for cable in queryset:
-            if regex.match(cable.name):
-                successes += 1
-            else:
-                self.log_failure(cable.device, "incorrectly named {} cable termination: {}".format(label, cable.name))
+        db_regex = _get_db_regex(regex, connections[queryset.db].vendor)
+        if db_regex is not None and memo is None:
+            successes = queryset.filter(name__regex=db_regex).count()
+            failures = queryset.exclude(name__regex=db_regex).select_related("device")
+        else:
+            if memo is None:
+                memo = RegexMemo(regex)
+            successes = 0
+            failing_names = []
+            for name, count in (
+                queryset.values("name").annotate(count=Count("pk")).values_list("name", "count").order_by()
+            ):
+                if memo.match(name):
+                    successes += count
+                else:
+                    failing_names.append(name)
+            memo.save()
+            failures = queryset.filter(name__in=failing_names).select_related("device") if failing_names else []
+
+        for cable in failures:
+            self.log_failure(cable.device, "incorrectly named {} cable termination: {}".format(label, cable.name))
 
         self.log_success(None, "{} correctly named {} cable terminations".format(successes, label))
 
@@ -94,58 +192,152 @@ class Cables(Report):
         )
 
     def test_interface_termination_names(self):
-        """Proxy to _port_names_test with values for checking interfaces."""
+        """Proxy to _port_names_test with values for checking interfaces.
+
+        Interface names repeat heavily across devices, so they are matched once per distinct name, with a memo.
+        """
+        regex = re.compile((r"|".join(INTERFACES_REGEXP)))
         self._port_names_test(
-            Interface.objects.exclude(device__status__in=EXCLUDE_STATUSES),
-            re.compile((r"|".join(INTERFACES_REGEXP))),
-            "interface",
+            Interface.objects.exclude(device__status__in=EXCLUDE_STATUSES), regex, "interface", memo=RegexMemo(regex),
         )
 
-    def _get_site_slug_for_cable(self, cable):
-        """Get a representative site slug given a cable.
+    @property
+    def cable_facts(self):
+        """The CableFacts of every cable, keyed by cable id in cable order, computed on first access."""
+        return self._data.cable_facts
+
+    def _get_cable_facts(self):
+        """Compute the CableFacts of every cable.
+
+        On incremental runs, only the cables which may have changed since the previous run are looked at, and the facts
+        about the others are carried forward: the cables updated since then, the cables attached to devices updated
+        since then (as their site may have changed), and the cables of circuit terminations, which are not
+        change-logged.
+        """
+        store = ResultStore("cables", __file__, models_fingerprint(Site))
+        facts = store.load()
+
+        cables = Cable.objects.all()
+        if store.incremental:
+            changed = set(Cable.objects.filter(last_updated__gte=store.since).values_list("pk", flat=True))
+            for model in DEVICE_TERMINATIONS:
+                changed.update(
+                    model.objects.filter(device__last_updated__gte=store.since, cable__isnull=False).values_list(
+                        "cable_id", flat=True
+                    )
+                )
+            changed.update(
+                Cable.objects.filter(
+                    termination_a_type=ContentType.objects.get_for_model(CircuitTermination)
+                ).values_list("pk", flat=True)
+            )
+            cables = cables.filter(pk__in=changed)
+
+        checked = self._compute_cable_facts(cables)
+        facts.update(checked)
+
+        removed = []
+        if store.incremental:
+            order = list(Cable.objects.values_list("pk", flat=True))
+            removed = facts.keys() - set(order)
+            # The cables created after the query above have no facts yet: compute them now
+            unchecked = [pk for pk in order if pk not in facts]
+            if unchecked:
+                late = self._compute_cable_facts(Cable.objects.filter(pk__in=unchecked))
+                checked.update(late)
+                facts.update(late)
+                order = [pk for pk in order if pk in facts]  # unless deleted in the meantime
+        else:
+            order = list(checked)
+        store.save(checked, removed)
+
+        return OrderedDict((pk, CableFacts(*facts[pk])) for pk in order)
+
+    def _compute_cable_facts(self, cables):
+        """Compute the facts of the given cables, as JSON serializable lists of the CableFacts fields."""
+        sites = self._get_site_slugs_for_cables(cables)
+        return OrderedDict(
+            (pk, [label, status, termination_a_id is not None and termination_b_id is not None, sites.get(pk, "none")])
+            for pk, label, status, termination_a_id, termination_b_id in cables.values_list(
+                "pk", "label", "status", "termination_a_id", "termination_b_id"
+            )
+        )
+
+    @staticmethod
+    def _get_site_slugs_for_cables(cables):
+        """Get a representative site slug for each of the given cables.
 
         Since cables do not have their own site objects, we need to get it from a subsidiary object, which,
         depending on the termination type, may be on the termination object or the device object in the termination.
+        The cables are grouped by termination type, and the sites of each group are fetched with a single query.
+
+        Arguments:
+            cables: A queryset of the cables to resolve the sites of.
+
+        Returns:
+            dict: The site slugs keyed by cable id. Cables without a resolvable site are not included.
+
         """
-        site = "none"
-        if cable.termination_a_type.name == "circuit termination" and cable.termination_a.site:
-            site = cable.termination_a.site.slug
-        elif cable.termination_a.device and cable.termination_a.device.site:
-            site = cable.termination_a.device.site.slug
-        return site
+        sites = {}
+        termination_types = cables.exclude(termination_a_id__isnull=True).values_list(
+            "termination_a_type_id", flat=True
+        )
+        for termination_type_id in termination_types.order_by().distinct():
+            model = ContentType.objects.get_for_id(termination_type_id).model_class()
+            field_names = {field.name for field in model._meta.get_fields()}
+            if "site" in field_names:  # e.g. circuit terminations
+                site_path = "site__slug"
+            elif "device" in field_names:
+                site_path = "device__site__slug"
+            else:
+                continue
+
+            site_slug = model.objects.filter(pk=OuterRef("termination_a_id")).values(site_path)[:1]
+            sites.update(
+                cables.filter(termination_a_type_id=termination_type_id)
+                .annotate(site_slug=Subquery(site_slug))
+                .exclude(site_slug__isnull=True)
+                .values_list("pk", "site_slug")
+                .order_by()
+            )
+        return sites
 
     def test_duplicate_cable_label(self):
         """Cables within sites should have unique labels."""
         labelcounts = defaultdict(list)
-        for cable in (
-            Cable.objects.exclude(label__isnull=True)
-            .exclude(label='')
-            .exclude(termination_a_id__isnull=True)
-            .exclude(termination_b_id__isnull=True)
-        ):
-            if cable.label.strip():
+        for pk, cable in self.cable_facts.items():
+            if cable.label and cable.terminated and cable.label.strip():
                 # Uniquify per site (duplicates between sites are ok, within sites not ok).
-                site = self._get_site_slug_for_cable(cable)
-                labelcounts[(cable.label.strip(), site)].append(cable)
+                labelcounts[(cable.label.strip(), cable.site)].append(pk)
 
         success = 0
-        for label, cables in labelcounts.items():
-            if len(cables) > 1:
-                for cable in cables:
-                    self.log_failure(cable, "duplicate cable label (site {})".format(label[1]))
+        duplicates = []
+        for label, pks in labelcounts.items():
+            if len(pks) > 1:
+                duplicates.extend((pk, label[1]) for pk in pks)
             else:
                 success += 1
+
+        cables = Cable.objects.in_bulk([pk for pk, _ in duplicates])
+        for pk, site in duplicates:
+            self.log_failure(cables[pk], "duplicate cable label (site {})".format(site))
         self.log_success(None, "{} non-duplicate cable labels.".format(success))
 
     def test_blank_cable_label(self):
         """Cables should not have blank labels."""
         success = 0
-        for cable in Cable.objects.filter(status=True):
+        blanks = []
+        for pk, cable in self.cable_facts.items():
+            if not cable.status:
+                continue
             if cable.label is None or not cable.label.strip():
-                site = self._get_site_slug_for_cable(cable)
-                if site in BLANK_CABLES_SITE_BLACKLIST:
+                if cable.site in BLANK_CABLES_SITE_BLACKLIST:
                     continue
-                self.log_failure(cable, "blank cable label (site {})".format(site))
+                blanks.append((pk, cable.site))
             else:
                 success += 1
+
+        cables = Cable.objects.in_bulk([pk for pk, _ in blanks])
+        for pk, site in blanks:
+            self.log_failure(cables[pk], "blank cable label (site {})".format(site))
         self.log_success(None, "{} non-blank cable labels".format(success))
@@ -3,7 +3,12 @@ Several integrity/coherence checks against the data.
 """
 
 import datetime
+import operator
+import os
 import re
+import sys
+from collections import OrderedDict, namedtuple
+from functools import reduce
 
 from dcim.constants import (
     DEVICE_STATUS_ACTIVE,
@@ -12,75 +17,302 @@ from dcim.constants import (
     DEVICE_STATUS_PLANNED,
     DEVICE_STATUS_INVENTORY,
 )
-from dcim.models import Device
+from dcim.models import Device, DeviceRole, Rack, Site
 from extras.reports import Report
-from extras.models import CustomFieldValue
 
-from django.db.models import Count, Prefetch
+from django.db.models import Case, Count, IntegerField, Q, Value, When
+from django.db.models.functions import Lower
+
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import (  # noqa: E402
+    ConsolePortIndex,
+    CustomFieldIndex,
+    DataProvider,
+    InstrumentationMixin,
+    ParallelMixin,
+    ResultStore,
+    models_fingerprint,
+)
 
 
 SITE_BLACKLIST = ()
 DEVICE_ROLE_BLACKLIST = ("cablemgmt", "storagebin", "optical-device")
 ASSET_TAG_RE = re.compile(r"WMF\d{4}")
 TICKET_RE = re.compile(r"RT #\d{2,}|T\d{5,}")
+# the custom fields used by the tests
+CUSTOM_FIELDS = ("purchase_date", "ticket")
+# the checks run by _check_device()
+DEVICE_CHECKS = ("purchase_dates", "tickets", "offline_rack", "online_rack")
 
 
-def cf(device, field):
-    """Get the value for the specified custom field name.
+class Rule(namedtuple("Rule", ("name", "applies_to", "failures"))):
+    """A declarative check on the devices, evaluated in the database by Coherence._run_rules().
 
-    This, combined with the a prefetch_related() results into much more
-    efficient access of custom fields and their values. See:
-    https://github.com/digitalocean/netbox/issues/3185
-
-    Be warned that this treats empty values as non-existing fields.
+    The rule applies to the devices matching the applies_to filter, or to all of them if None. The failures are
+    (filter, log method, message) tuples: a device fails with the first one whose filter it matches, and passes if it
+    matches none. The message is formatted with the device.
     """
-    for cfv in device.custom_field_values.all():
-        if cfv.field.name == field:
-            return cfv.value
-    return None
 
+    __slots__ = ()
+
+    def _restrict(self, condition):
+        return condition if self.applies_to is None else self.applies_to & condition
 
-# monkey-patch the Device model for easy access to our custom cf() function
-Device.mpcf = cf
+    @property
+    def failing(self):
+        """The filter of the devices failing the rule."""
+        return self._restrict(reduce(operator.or_, (condition for condition, _, _ in self.failures)))
 
+    @property
+    def passing(self):
+        """The filter of the devices passing the rule."""
+        return self._restrict(~reduce(operator.or_, (condition for condition, _, _ in self.failures)))
 
-def _get_devices_query(cf=False):
-    devices = Device.objects.exclude(site__slug__in=SITE_BLACKLIST)
-    if cf:
-        devices = devices.prefetch_related(
-            Prefetch("custom_field_values", queryset=CustomFieldValue.objects.select_related("field"))
+    @property
+    def outcome(self):
+        """An expression for the index in failures of the failure of a device, None if it does not fail."""
+        return Case(
+            *(When(self._restrict(condition), then=Value(i)) for i, (condition, _, _) in enumerate(self.failures)),
+            output_field=IntegerField()
         )
 
-    return devices
+
+# the checks run by Coherence._run_rules(), in the database
+DEVICE_RULES = (
+    Rule(
+        "asset_tags",
+        None,
+        (
+            (Q(asset_tag__isnull=True), "log_failure", "missing asset tag"),
+            (
+                ~Q(asset_tag__regex=r"^(?:{})$".format(ASSET_TAG_RE.pattern)),
+                "log_failure",
+                "malformed asset tag: {device.asset_tag}",
+            ),
+        ),
+    ),
+    Rule(
+        "serials",
+        ~Q(status__in=(DEVICE_STATUS_DECOMMISSIONING, DEVICE_STATUS_OFFLINE))
+        & ~Q(device_role__slug__in=DEVICE_ROLE_BLACKLIST),
+        ((Q(serial__isnull=True) | Q(serial=""), "log_failure", "missing serial"),),
+    ),
+    Rule(
+        "names",
+        None,
+        (
+            (
+                ~Q(name=Lower("name")) & Q(status=DEVICE_STATUS_ACTIVE),
+                "log_failure",
+                "malformed device name for active device",
+            ),
+            (~Q(name=Lower("name")), "log_warning", "malformed device name for inactive device"),
+        ),
+    ),
+)
+
+
+def _get_devices_query():
+    """Get the query for all the devices considered by the report, with the relations the tests need preloaded."""
+    return Device.objects.exclude(site__slug__in=SITE_BLACKLIST).select_related("site", "rack", "device_role")
+
+
+def _check_device(device, custom_fields, today):
+    """Run all the per-device checks on a device.
+
+    Arguments:
+        device (dcim.models.Device): the device to check.
+        custom_fields (_common.CustomFieldIndex): the index of the custom fields of the device.
+        today (datetime.date): the current date.
+
+    Returns:
+        dict: the outcome of each check keyed by check name, True on success or a [log method, message] list
+        otherwise. The checks which do not apply to the device are omitted.
+
+    """
+    results = {}
+
+    purchase_date = custom_fields.get(device, "purchase_date")
+    if purchase_date is None:
+        results["purchase_dates"] = ["log_failure", "missing purchase date"]
+    elif purchase_date > today:
+        results["purchase_dates"] = ["log_failure", "purchase date is in the future"]
+    else:
+        results["purchase_dates"] = True
+
+    raw_ticket = custom_fields.get(device, "ticket")
+    ticket = str(raw_ticket)
+    if TICKET_RE.fullmatch(ticket):
+        results["tickets"] = True
+    elif raw_ticket is None:
+        results["tickets"] = ["log_failure", "missing procurement ticket"]
+    else:
+        results["tickets"] = ["log_failure", "malformed procurement ticket: {}".format(ticket)]
+
+    if device.status == DEVICE_STATUS_OFFLINE and device.rack is not None:
+        results["offline_rack"] = [
+            "log_failure",
+            "rack defined for status {status} device: {site}-{rack}".format(
+                status="Offline", site=device.site.slug, rack=device.rack.name
+            ),
+        ]
+
+    if device.rack is None and device.status not in (
+        DEVICE_STATUS_OFFLINE,
+        DEVICE_STATUS_PLANNED,
+        DEVICE_STATUS_INVENTORY,
+    ):
+        results["online_rack"] = [
+            "log_failure",
+            "no rack defined for status {} device".format(device.get_status_display()),
+        ]
+
+    return results
+
+
+class CheckResult:
+    """The log entries and success count of a single check, to be replayed by the relevant test_* method.
+
+    Warnings are replayed after all the failures.
+    """
+
+    def __init__(self):
+        self.failures = []
+        self.warnings = []
+        self.successes = 0
+
+    def add(self, outcome, device):
+        """Add the outcome of the check on a device, as returned by _check_device()."""
+        if outcome is True:
+            self.successes += 1
+        elif outcome[0] == "log_warning":
+            self.warnings.append((outcome[0], device, outcome[1]))
+        else:
+            self.failures.append((outcome[0], device, outcome[1]))
+
+    @property
+    def entries(self):
+        return self.failures + self.warnings
 
 
-class Coherence(Report):
+class Coherence(ParallelMixin, InstrumentationMixin, Report):
     description = __doc__
+    preload = ("_data.check_results", "_data.rule_results")
+
+    def __init__(self, *args, **kwargs):
+        self._data = DataProvider(check_results=self._run_device_checks, rule_results=self._run_rules)
+
+        super().__init__(*args, **kwargs)
+
+    def _run_device_checks(self):
+        """Run all the per-device checks which can't be expressed as rules in a single pass over the devices.
+
+        The results are grouped per check, so that every test_* method still logs its own results. On incremental
+        runs, only the devices updated since the previous run are checked, and the results of the others are carried
+        forward; the results are the same as those of a full run.
+        """
+        today = datetime.date.today()
+        store = ResultStore("coherence", __file__, [today.isoformat(), models_fingerprint(Site, Rack, DeviceRole)])
+        results = store.load()
+
+        checked = OrderedDict()  # in the order of the device query, which is the order of the logs on full runs
+        failing = OrderedDict()  # only the devices with failures or warnings are kept, to be logged
+
+        def check_devices(devices, custom_fields):
+            for device in devices.iterator():
+                checked[device.pk] = _check_device(device, custom_fields, today)
+                if any(outcome is not True for outcome in checked[device.pk].values()):
+                    failing[device.pk] = device
+
+        devices = _get_devices_query()
+        if store.incremental:
+            devices = devices.filter(last_updated__gte=store.since)
+            check_devices(devices, CustomFieldIndex(Device, CUSTOM_FIELDS, queryset=devices))
+        else:
+            check_devices(devices, CustomFieldIndex(Device, CUSTOM_FIELDS))
+        results.update(checked)
+
+        removed = []
+        if store.incremental:
+            order = list(_get_devices_query().values_list("pk", flat=True))
+            removed = results.keys() - set(order)
+            # The devices created after the query above have no result yet: check them now
+            unchecked = [pk for pk in order if pk not in results]
+            if unchecked:
+                devices = _get_devices_query().filter(pk__in=unchecked)
+                check_devices(devices, CustomFieldIndex(Device, CUSTOM_FIELDS, queryset=devices))
+                results.update(checked)
+                order = [pk for pk in order if pk in results]  # unless deleted in the meantime
+            missing = [
+                pk for pk in order if pk not in failing and any(outcome is not True for outcome in results[pk].values())
+            ]
+            failing.update(Device.objects.in_bulk(missing))
+        else:
+            order = list(checked)
+        store.save(checked, removed)
+
+        check_results = {check: CheckResult() for check in DEVICE_CHECKS}
+        for pk in order:
+            for check, outcome in results[pk].items():
+                check_results[check].add(outcome, failing.get(pk))
+        return check_results
+
+    def _run_rules(self):
+        """Evaluate all the DEVICE_RULES in the database.
+
+        The success counts of all the rules are computed with a single aggregate query, and only the devices failing
+        at least one rule are fetched, annotated with the outcome of each rule, with a second one.
+        """
+        devices = _get_devices_query()
+        rule_results = {rule.name: CheckResult() for rule in DEVICE_RULES}
+
+        successes = devices.aggregate(
+            **{"rule_" + rule.name: Count("pk", filter=rule.passing) for rule in DEVICE_RULES}
+        )
+        for rule in DEVICE_RULES:
+            rule_results[rule.name].successes = successes["rule_" + rule.name]
+
+        failing = devices.filter(reduce(operator.or_, (rule.failing for rule in DEVICE_RULES))).annotate(
+            **{"rule_" + rule.name: rule.outcome for rule in DEVICE_RULES}
+        )
+        for device in failing:
+            for rule in DEVICE_RULES:
+                index = getattr(device, "rule_" + rule.name)
+                if index is not None:
+                    _, log_method, message = rule.failures[index]
+                    rule_results[rule.name].add([log_method, message.format(device=device)], device)
+
+        return rule_results
+
+    def _replay_check(self, check):
+        """Log the entries of the given check, running all the device checks or rules first if needed.
+
+        Arguments:
+            check (str): the name of the check, as keyed in _check_device() or in DEVICE_RULES.
+
+        Returns:
+            CheckResult: the result of the check.
+
+        """
+        if check in DEVICE_CHECKS:
+            result = self._data.check_results[check]
+        else:
+            result = self._data.rule_results[check]
+        for log_method, device, message in result.entries:
+            getattr(self, log_method)(device, message)
+        return result
 
     def test_malformed_asset_tags(self):
         """Test for missing asset tags and incorrectly formatted asset tags."""
-        success_count = 0
-        for device in _get_devices_query():
-            if device.asset_tag is None:
-                self.log_failure(device, "missing asset tag")
-            elif not ASSET_TAG_RE.fullmatch(device.asset_tag):
-                self.log_failure(device, "malformed asset tag: {}".format(device.asset_tag))
-            else:
-                success_count += 1
-        self.log_success(None, "{} correctly formatted asset tags".format(success_count))
+        result = self._replay_check("asset_tags")
+        self.log_success(None, "{} correctly formatted asset tags".format(result.successes))
 
     def test_purchase_date(self):
         """Test that each device has a purchase date."""
-        success_count = 0
-        for device in _get_devices_query(cf=True):
-            purchase_date = device.mpcf("purchase_date")
-            if purchase_date is None:
-                self.log_failure(device, "missing purchase date")
-            elif purchase_date > datetime.datetime.today().date():
-                self.log_failure(device, "purchase date is in the future")
-            else:
-                success_count += 1
-        self.log_success(None, "{} present purchase dates".format(success_count))
+        result = self._replay_check("purchase_dates")
+        self.log_success(None, "{} present purchase dates".format(result.successes))
 
     def test_duplicate_serials(self):
         """Test that all serial numbers are unique."""
@@ -110,78 +342,35 @@ class Coherence(Report):
 
     def test_serials(self):
         """Determine if all serials are non-null."""
-        success_count = 0
-        for device in (
-            _get_devices_query()
-            .exclude(status__in=(DEVICE_STATUS_DECOMMISSIONING, DEVICE_STATUS_OFFLINE))
-            .exclude(device_role__slug__in=DEVICE_ROLE_BLACKLIST)
-        ):
-            if device.serial is None or device.serial == "":
-                self.log_failure(device, "missing serial")
-            else:
-                success_count += 1
-        self.log_success(None, "{} present serials".format(success_count))
+        result = self._replay_check("serials")
+        self.log_success(None, "{} present serials".format(result.successes))
 
     def test_ticket(self):
         """Determine if the procurement ticket matches the expected format."""
-        success_count = 0
-        for device in _get_devices_query(cf=True):
-            ticket = str(device.mpcf("ticket"))
-            if TICKET_RE.fullmatch(ticket):
-                success_count += 1
-            elif device.mpcf("ticket") is None:
-                self.log_failure(device, "missing procurement ticket")
-            else:
-                self.log_failure(device, "malformed procurement ticket: {}".format(ticket))
-
-        self.log_success(None, "{} correctly formatted procurement tickets".format(success_count))
+        result = self._replay_check("tickets")
+        self.log_success(None, "{} correctly formatted procurement tickets".format(result.successes))
 
     def test_offline_rack(self):
         """Determine if offline boxes are (erroneously) assigned a rack."""
-        devices = _get_devices_query().filter(status=DEVICE_STATUS_OFFLINE).exclude(rack=None)
-        devices = devices.select_related("site", "rack")
-        for device in devices:
-            self.log_failure(
-                device,
-                "rack defined for status {status} device: {site}-{rack}".format(
-                    status="Offline", site=device.site.slug, rack=device.rack.name
-                ),
-            )
+        self._replay_check("offline_rack")
 
     def test_online_rack(self):
         """Determine if online boxes are (erroneously) lacking a rack assignment."""
-        for device in (
-            _get_devices_query()
-            .exclude(status__in=(DEVICE_STATUS_OFFLINE, DEVICE_STATUS_PLANNED, DEVICE_STATUS_INVENTORY))
-            .filter(rack=None)
-        ):
-            self.log_failure(device, "no rack defined for status {} device".format(device.get_status_display()))
+        self._replay_check("online_rack")
 
     def test_connected_unracked(self):
         """Determine if unracked boxes still have console connections marked as conneced."""
-        for device in _get_devices_query().filter(rack=None):
-            consoleports = device.consoleports.all()
-            good = True
-            msgs = ["connected console ports attached to unracked device {}:".format(device.name)]
-            for port in consoleports:
-                if port.connection_status:
-                    msgs.append(port.name)
-                    good = False
-            if not good:
+        devices = _get_devices_query().filter(rack=None)
+        unracked = list(devices)
+        consoleports = ConsolePortIndex(devices)
+        connected_names = consoleports.connected_names(unracked)
+        for device in unracked:
+            if device.pk in connected_names:
+                msgs = ["connected console ports attached to unracked device {}:".format(device.name)]
+                msgs.extend(connected_names[device.pk])
                 self.log_failure(device, " ".join(msgs))
 
     def test_device_name(self):
         """Device names should be lower case."""
-        success = 0
-        warnings = []
-        for device in _get_devices_query():
-            if device.name.lower() != device.name:
-                if device.status == DEVICE_STATUS_ACTIVE:
-                    self.log_failure(device, "malformed device name for active device")
-                else:
-                    warnings.append(device)
-            else:
-                success += 1
-
-        [self.log_warning(x, "malformed device name for inactive device") for x in warnings]
-        self.log_success(None, "{} correctly formatted device names".format(success))
+        result = self._replay_check("names")
+        self.log_success(None, "{} correctly formatted device names".format(result.successes))
@@ -5,12 +5,20 @@ And the other way around.
 """
 
 import csv
-from collections import OrderedDict
+import json
+import os
+import sys
+from collections import OrderedDict, namedtuple
 
 from dcim.constants import DEVICE_STATUS_DECOMMISSIONING, DEVICE_STATUS_OFFLINE
 from dcim.models import Device, InventoryItem
 from extras.reports import Report
 
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import DataProvider, InstrumentationMixin, ParallelMixin, log_load_time  # noqa: E402
+
 # Status we are fine not having support on
 STATUS_IGNORE = (DEVICE_STATUS_OFFLINE, DEVICE_STATUS_DECOMMISSIONING)
 
@@ -22,72 +30,192 @@ PRODUCT_NAMES_IGNORE = [
 ]
 
 CSVFILE = "/tmp/juniper_installed_base.csv"
+# Cache of the parsed CSV, keyed by the CSV file path, mtime and size
+CACHE_FILE = "/tmp/juniper_installed_base.json"
+
+# The columns of the CSV used by the tests
+SERIAL_COLUMN = "Serial #"
+ASSET_COLUMNS = ("Product Name", "Install City", "Status", "Contract End Date")
+InstalledBaseAsset = namedtuple("InstalledBaseAsset", ("product_name", "install_city", "status", "contract_end_date"))
+
+# The Juniper devices and inventory items with a serial, in query order and keyed by serial
+NetboxIndex = namedtuple("NetboxIndex", ("devices", "inventory", "devices_by_serial", "inventory_by_serial"))
+
 
+class InstalledBaseError(Exception):
+    """Raised when the installed base CSV can't be loaded."""
 
-class Juniper(Report):
+
+class Juniper(ParallelMixin, InstrumentationMixin, Report):
     description = """
     Checks the consistency of Netbox data against a csv export of the my.juniper.net installed base.
     And the other way around.
     """
+    preload = ("sources.installed_base", "_netbox.index")
 
     def __init__(self, *args, **kwargs):
-        """Loads the CSV."""
+        """Sets up the lazy loading of the CSV."""
 
-        self.installed_base = self.load_installed_base()
+        self.sources = DataProvider(on_load=log_load_time(self), installed_base=self.load_installed_base)
+        self._netbox = DataProvider(index=self._get_netbox_index)
 
         super().__init__(*args, **kwargs)
 
     @staticmethod
-    def load_installed_base():
-        installed_base = OrderedDict()
-        full_csv = []
+    def load_installed_base(path=CSVFILE, cache_file=CACHE_FILE):
+        """Loads the installed base, from the cache if the CSV file did not change since it was last parsed.
+
+        Returns:
+            collections.OrderedDict: the InstalledBaseAsset objects keyed by serial number.
 
+        Raises:
+            InstalledBaseError: if the CSV file can't be read or parsed.
+
+        """
         try:
-            with open(CSVFILE, newline="") as csvfile:
-                full_csv = list(csv.reader(csvfile, delimiter=","))
-        except IOError:
-            return None
+            stat = os.stat(path)
+        except OSError as e:
+            raise InstalledBaseError("Can't load CSV file from {}: {}".format(path, e))
+        key = [path, stat.st_mtime_ns, stat.st_size]
 
-        column_names = full_csv[0]
+        try:
+            with open(cache_file) as f:
+                cache = json.load(f)
+            if cache["key"] == key:
+                return OrderedDict((serial, InstalledBaseAsset(*asset)) for serial, asset in cache["assets"])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
 
-        for row in full_csv[1:]:
-            # Remove some /t from values
-            row = [x.strip() for x in row]
-            asset = dict(zip(column_names, row))
-            # skip items without a serial number
-            if asset["Serial #"] == "":
-                continue
+        installed_base = Juniper.parse_installed_base(path)
 
-            # Ignore licenses
-            if "-LIC" in asset["Product Name"]:
-                continue
+        tmp_file = "{}.tmp".format(cache_file)
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump({"key": key, "assets": list(installed_base.items())}, f)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            # not being able to cache is not fatal, the CSV will just be parsed again next time
+            pass
 
-            # Ignore DACs
-            if "-DAC-" in asset["Product Name"]:
-                continue
+        return installed_base
 
-            # Ignore DACs serials
-            if asset["Product Name"] in PRODUCT_NAMES_IGNORE:
-                continue
+    @staticmethod
+    def parse_installed_base(path):
+        """Parses the CSV file row by row, keeping only the columns used by the tests.
 
-            installed_base[asset["Serial #"]] = asset
+        Returns:
+            collections.OrderedDict: the InstalledBaseAsset objects keyed by serial number.
+
+        Raises:
+            InstalledBaseError: if the CSV file can't be read or parsed.
+
+        """
+        installed_base = OrderedDict()
+
+        try:
+            with open(path, newline="") as csvfile:
+                reader = csv.reader(csvfile, delimiter=",")
+                try:
+                    header = [x.strip() for x in next(reader)]
+                    serial_index = header.index(SERIAL_COLUMN)
+                    indexes = [header.index(column) for column in ASSET_COLUMNS]
+                except StopIteration:
+                    raise InstalledBaseError("{}, row 1: missing header".format(path))
+                except ValueError as e:
+                    raise InstalledBaseError("{}, row 1: missing column in header: {}".format(path, e))
+                row_length = max(indexes + [serial_index]) + 1
+
+                for row in reader:
+                    if not row:
+                        continue
+                    if len(row) < row_length:
+                        raise InstalledBaseError(
+                            "{}, row {}: expected at least {} columns, got {}".format(
+                                path, reader.line_num, row_length, len(row)
+                            )
+                        )
+
+                    # Remove some /t from values
+                    serial = row[serial_index].strip()
+                    asset = InstalledBaseAsset(*(row[i].strip() for i in indexes))
+
+                    # skip items without a serial number
+                    if serial == "":
+                        continue
+
+                    # Ignore licenses
+                    if "-LIC" in asset.product_name:
+                        continue
+
+                    # Ignore DACs
+                    if "-DAC-" in asset.product_name:
+                        continue
+
+                    # Ignore DACs serials
+                    if asset.product_name in PRODUCT_NAMES_IGNORE:
+                        continue
+
+                    installed_base[serial] = asset
+        except csv.Error as e:
+            raise InstalledBaseError("{}, row {}: {}".format(path, reader.line_num, e))
+        except OSError as e:
+            raise InstalledBaseError("Can't load CSV file from {}: {}".format(path, e))
 
         return installed_base
 
-    def test_missing_device_from_installed_base(self):
-        if not self.installed_base:
-            self.log_failure(None, "Can't load CSV file from {}".format(CSVFILE))
-            return
-        juniper_devices = (
+    @property
+    def netbox_index(self):
+        """The NetboxIndex of the Juniper devices and inventory items, built on first access."""
+        return self._netbox.index
+
+    @staticmethod
+    def _get_netbox_index():
+        """Index the Juniper devices and inventory items with a serial, with a query each.
+
+        The sites of the devices, and the parent devices of the inventory items with their manufacturers, are joined
+        in the same queries.
+        """
+        devices = list(
             Device.objects.exclude(serial__isnull=True)
             .exclude(serial="")
-            .exclude(status__in=STATUS_IGNORE)
             .filter(device_type__manufacturer__slug="juniper")
+            .select_related("site")
+        )
+        inventory = list(
+            InventoryItem.objects.exclude(serial__isnull=True)
+            .exclude(serial="")
+            .filter(manufacturer__slug="juniper")
+            .select_related("device__device_type__manufacturer")
+        )
+        return NetboxIndex(
+            devices,
+            inventory,
+            {device.serial: device for device in devices},
+            {item.serial: item for item in inventory},
         )
 
+    def _get_installed_base(self):
+        """Get the installed base, logging a failure and returning None if it could not be loaded or is empty."""
+        try:
+            installed_base = self.sources.installed_base
+        except InstalledBaseError as e:
+            self.log_failure(None, str(e))
+            return None
+
+        if not installed_base:
+            self.log_failure(None, "Empty CSV file {}".format(CSVFILE))
+            return None
+        return installed_base
+
+    def test_missing_device_from_installed_base(self):
+        installed_base = self._get_installed_base()
+        if installed_base is None:
+            return
+        juniper_devices = (device for device in self.netbox_index.devices if device.status not in STATUS_IGNORE)
+
         device_matches = 0
         for device in juniper_devices:
-            if device.serial not in self.installed_base:
+            if device.serial not in installed_base:
                 self.log_failure(
                     device,
                     "Device with s/n {serial} not present in Juniper Installed Base".format(serial=device.serial),
@@ -99,24 +227,18 @@ class Juniper(Report):
             self.log_success(None, "{} devices matched".format(device_matches))
 
     def test_missing_inventory_from_installed_base(self):
-        if not self.installed_base:
-            self.log_failure(None, "Can't load CSV file from {}".format(CSVFILE))
+        installed_base = self._get_installed_base()
+        if installed_base is None:
             return
-        parents = (
-            Device.objects.values_list("pk", flat=True)
-            .filter(device_type__manufacturer__slug="juniper")
-            .exclude(status__in=STATUS_IGNORE)
-        )
-
         juniper_inventory = (
-            InventoryItem.objects.exclude(serial__isnull=True)
-            .exclude(serial="")
-            .filter(device_id__in=parents, manufacturer__slug="juniper")
+            item
+            for item in self.netbox_index.inventory
+            if item.device.device_type.manufacturer.slug == "juniper" and item.device.status not in STATUS_IGNORE
         )
 
         device_matches = 0
         for inventory_item in juniper_inventory:
-            if inventory_item.serial not in self.installed_base:
+            if inventory_item.serial not in installed_base:
                 self.log_failure(
                     inventory_item,
                     "{parent_name} item {part_id} with s/n {serial} not present in Juniper Installed Base".format(
@@ -132,29 +254,16 @@ class Juniper(Report):
             self.log_success(None, "{} inventory items matched".format(device_matches))
 
     def test_consistency(self):
-        if not self.installed_base:
-            self.log_failure(None, "Can't load CSV file from {}".format(CSVFILE))
+        installed_base = self._get_installed_base()
+        if installed_base is None:
             return
-        juniper_devices = (
-            Device.objects.exclude(serial__isnull=True)
-            .exclude(serial="")
-            .filter(device_type__manufacturer__slug="juniper")
-        )
-        juniper_inventory = (
-            InventoryItem.objects.exclude(serial__isnull=True).exclude(serial="").filter(manufacturer__slug="juniper")
-        )
-        devices = {}
-        for device in juniper_devices:
-            devices[device.serial] = device
-
-        inventory_items = {}
-        for item in juniper_inventory:
-            inventory_items[item.serial] = item
+        devices = self.netbox_index.devices_by_serial
+        inventory_items = self.netbox_index.inventory_by_serial
 
         serial_matches = address_matches = support_matches = 0
-        for serial, asset in self.installed_base.items():
+        for serial, asset in installed_base.items():
             is_inventory_item = False
-            name = asset["Product Name"]
+            name = asset.product_name
             try:
                 device = devices[serial]
             except KeyError:
@@ -171,7 +280,7 @@ class Juniper(Report):
             # TODO: check city/support of inventory items
             if not is_inventory_item:
                 # TODO: Only use the cities to check if the "intalled at" is correct
-                city = asset["Install City"].lower()
+                city = asset.install_city.lower()
                 if city not in device.site.physical_address.lower():
                     self.log_failure(
                         device,
@@ -182,8 +291,8 @@ class Juniper(Report):
                 else:
                     address_matches += 1
 
-                active_support = True if asset["Status"] == "Active" else False
-                support_end_date = asset["Contract End Date"]
+                active_support = True if asset.status == "Active" else False
+                support_end_date = asset.contract_end_date
                 if device.status not in STATUS_IGNORE and not active_support and support_end_date != "":
                     self.log_failure(
                         device,
@@ -3,15 +3,30 @@ Report parity errors between LibreNMS and Netbox.
 """
 
 import configparser
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
+
 import pymysql
 
-from django.db.models import Q
+from django.db.models import BooleanField, Case, Q, Value, When
 
 from dcim.constants import DEVICE_STATUS_ACTIVE, DEVICE_STATUS_STAGED
 from dcim.models import Device, InventoryItem
 from extras.reports import Report
 
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import DataProvider, InstrumentationMixin, ParallelMixin, log_load_time, process_singleton  # noqa: E402
+
 CONFIG_FILE = "/etc/netbox/reports.cfg"
+# Defaults for the process-level cache of the LibreNMS data and for its database connection, can be overridden with
+# the cache_ttl and timeout keys (in seconds) in the librenms section of the config file.
+CACHE_TTL = 3600
+LIBRENMS_TIMEOUT = 30
 
 # Netbox system states to check.
 INCLUDE_STATUSES = (DEVICE_STATUS_ACTIVE, DEVICE_STATUS_STAGED)
@@ -63,82 +78,316 @@ INVENTORY_MANUFACTURERS = ("juniper",)
 MODEL_EQUIVS = {"juniper ex4300-48t": "juniper routing engine"}
 
 
+# The queries of the LibreNMS rows, and of the serials found more than once with their counts
+DEVICES_WHERE = 'serial IS NOT NULL AND serial NOT IN ("", "N/A")'
+DEVICES_QUERY = (
+    """SELECT device_id as id,
+              lower(hardware) as hardware,
+              lower(sysDescr) as description,
+              serial,
+              hostname
+       FROM devices
+       WHERE {}
+       ORDER BY device_id;"""
+).format(DEVICES_WHERE)
+# The serials are compared as binary strings, as in Python, not with the case-insensitive PAD SPACE default collation
+DEVICE_DUPLICATES_QUERY = (
+    "SELECT min(serial), count(*) FROM devices WHERE {} GROUP BY BINARY serial HAVING count(*) > 1;"
+).format(DEVICES_WHERE)
+# Some serials in inventory items have a S/N as their first token.
+INVENTORY_SERIAL = (
+    "IF(entPhysicalSerialNum LIKE BINARY 'S/N %', SUBSTRING(entPhysicalSerialNum, 5), entPhysicalSerialNum)"
+)
+INVENTORY_WHERE = 'entPhysicalSerialNum IS NOT NULL AND entPhysicalSerialNum NOT IN ("", "BUILTIN")'
+INVENTORY_QUERY = (
+    """SELECT {} as serial,
+              lower(entPhysicalName) as model,
+              lower(entPhysicalVendorType) as vendor
+       FROM entPhysical
+       WHERE {}
+       ORDER BY entPhysical_id;"""
+).format(INVENTORY_SERIAL, INVENTORY_WHERE)
+INVENTORY_DUPLICATES_QUERY = (
+    "SELECT min({0}), count(*) FROM entPhysical WHERE {1} GROUP BY BINARY {0} HAVING count(*) > 1;"
+).format(INVENTORY_SERIAL, INVENTORY_WHERE)
+
+# Cheap query whose result changes whenever the data loaded by the queries above may have: the serials, hardware and
+# descriptions of the devices, and the inventory, are updated by the LibreNMS discovery
+CHANGE_QUERY = """SELECT (SELECT count(*) FROM devices),
+                         (SELECT max(device_id) FROM devices),
+                         (SELECT max(last_discovered) FROM devices),
+                         (SELECT count(*) FROM entPhysical),
+                         (SELECT max(entPhysical_id) FROM entPhysical);"""
+
+# Compact records for the LibreNMS rows, keeping only the columns used by the tests.
+LibreNMSDevice = namedtuple("LibreNMSDevice", ("id", "hostname", "hardware", "description"))
+LibreNMSInventoryItem = namedtuple("LibreNMSInventoryItem", ("vendor", "model"))
+# The attributes of the Netbox devices used by the tests, including whether they match MODEL_EXCLUDES and
+# DEVICE_EXCLUDES.
+NetboxDevice = namedtuple(
+    "NetboxDevice",
+    ("pk", "serial", "role", "vendor", "vendor_slug", "model", "site", "model_excluded", "device_excluded"),
+)
+
+
+class SubstringMatcher:
+    """Multi-pattern substring matcher, an Aho-Corasick automaton compiled once from all the patterns.
+
+    It finds all the patterns contained in a text in a single pass over the text, whatever the number of patterns, and
+    remembers the result for each text, as the same strings come up many times.
+    """
+
+    def __init__(self, patterns):
+        """Compile the automaton.
+
+        Arguments:
+            patterns (iterable): the strings to look for.
+
+        """
+        patterns = set(patterns)
+        self._always = frozenset(pattern for pattern in patterns if not pattern)  # contained in any string
+        self._goto = [{}]
+        self._outputs = [set()]
+        for pattern in patterns:
+            if not pattern:
+                continue
+            state = 0
+            for char in pattern:
+                if char not in self._goto[state]:
+                    self._goto.append({})
+                    self._outputs.append(set())
+                    self._goto[state][char] = len(self._goto) - 1
+                state = self._goto[state][char]
+            self._outputs[state].add(pattern)
+
+        # Breadth first, so that the fail link of a state points to a state already complete
+        self._fail = [0] * len(self._goto)
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                # the states right below the root fall back to it
+                self._fail[next_state] = self._goto[fail].get(char, 0) if state else 0
+                self._outputs[next_state] |= self._outputs[self._fail[next_state]]
+
+        self._found = {}
+
+    def find(self, text):
+        """Get the patterns contained in the text.
+
+        Returns:
+            frozenset: the patterns found.
+
+        """
+        try:
+            return self._found[text]
+        except KeyError:
+            pass
+
+        found = set(self._always)
+        state = 0
+        for char in text:
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            found |= self._outputs[state]
+
+        self._found[text] = frozenset(found)
+        return self._found[text]
+
+
 class LibreNMSData:
     """This is a wrapper for the LibreNMS database which does some preprocessing of the return values."""
 
-    def __init__(self, host, port, user, password, database):
-        """Populate internal state from the LibreNMS database given MySQL connection parameters."""
-        connection = pymysql.connect(host=host, port=int(port), user=user, password=password, database=database)
+    def __init__(self):
+        """Initialize an empty state, to be populated with load_devices() and load_inventory().
 
+        The duplicate serials and their counts are set apart, in device_duplicates and inventory_duplicates.
+        """
         self.device_duplicates = {}
         self.inventory_duplicates = {}
         self.devices = {}
         self.inventory = {}
-        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+
+    @classmethod
+    def from_connection(cls, connection):
+        """Populate internal state from the LibreNMS database through an open pymysql connection."""
+        data = cls()
+        # Use an unbuffered server-side cursor, so that the rows are normalized and stored as they arrive instead of
+        # being all held in memory as dicts first.
+        with connection.cursor(pymysql.cursors.SSCursor) as cursor:
             # populate devices list by serial
-            cursor.execute(
-                """SELECT device_id as id,
-                          lower(hardware) as hardware,
-                          lower(sysDescr) as description,
-                          serial,
-                          hostname
-                   FROM devices
-                   WHERE serial IS NOT NULL
-                     AND serial NOT IN ("", "N/A");"""
-            )
-            for device in cursor.fetchall():
-                if not device["hardware"]:
-                    # Unexpectedly, some devices will return an null for hardware.
-                    device["hardware"] = "UNKNOWN"
-                # Juniper hardware column sometimes has nodeN at the start.
-                if device["hardware"].startswith("node"):
-                    device["hardware"] = device["hardware"].split(" ", 1)[1]
-
-                if device["serial"] in self.devices:
-                    self.device_duplicates.setdefault(device["serial"], 1)
-                    self.device_duplicates[device["serial"]] += 1
-
-                self.devices[device["serial"]] = device
+            cursor.execute(DEVICES_QUERY)
+            data.load_devices(cursor.fetchall_unbuffered())
+            cursor.execute(DEVICE_DUPLICATES_QUERY)
+            data.device_duplicates = dict(cursor.fetchall_unbuffered())
             # populate inventory list by serial
-            cursor.execute(
-                """SELECT entPhysical_id as id,
-                          lower(entPhysicalDescr) as description,
-                          entPhysicalSerialNum as serial,
-                          lower(entPhysicalName) as model,
-                          lower(entPhysicalVendorType) as vendor
-                   FROM entPhysical
-                   WHERE entPhysicalSerialNum IS NOT NULL
-                         AND entPhysicalSerialNum NOT IN ("", "BUILTIN");"""
-            )
-            for inventory_item in cursor.fetchall():
-                if inventory_item["serial"] in self.inventory:
-                    # Unlikely situation that two devices have the same serial number
-                    self.inventory_duplicates.setdefault(inventory_item["serial"], 1)
-                    self.inventory_duplicates[inventory_item["serial"]] += 1
+            cursor.execute(INVENTORY_QUERY)
+            data.load_inventory(cursor.fetchall_unbuffered())
+            cursor.execute(INVENTORY_DUPLICATES_QUERY)
+            data.inventory_duplicates = dict(cursor.fetchall_unbuffered())
+
+        return data
+
+    def load_devices(self, rows):
+        """Normalize and store rows of the devices table, as (id, hardware, description, serial, hostname) tuples.
+
+        If several rows have the same serial, the last one is kept: the one with the highest id with DEVICES_QUERY.
+        """
+        for device_id, hardware, description, serial, hostname in rows:
+            if not hardware:
+                # Unexpectedly, some devices will return an null for hardware.
+                hardware = "UNKNOWN"
+            # Juniper hardware column sometimes has nodeN at the start.
+            if hardware.startswith("node"):
+                hardware = hardware.split(" ", 1)[1]
+
+            self.devices[serial] = LibreNMSDevice(device_id, hostname, hardware, description)
+
+    def load_inventory(self, rows):
+        """Store rows of the entPhysical table, as (serial, model, vendor) tuples, with the serial normalized as by
+        INVENTORY_SERIAL.
+
+        If several rows have the same serial, the last one is kept: the one with the highest id with INVENTORY_QUERY.
+        """
+        for serial, model, vendor in rows:
+            self.inventory[serial] = LibreNMSInventoryItem(vendor, model)
+
+
+class LibreNMSCache:
+    """Process-level cache of the LibreNMS data, shared by the runs of the report, over a single reused connection.
+
+    The data is reused as long as it is younger than the TTL and a cheap change check on the LibreNMS tables (see
+    CHANGE_QUERY) gives the same result as when it was loaded. Otherwise it is loaded again. The report uses a single
+    instance per process, through process_singleton().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self._data = None
+        self._loaded = None
+        self._fingerprint = None
+
+    def get(self, config):
+        """Get the LibreNMS data, loading it only if needed.
+
+        Arguments:
+            config (configparser.SectionProxy): the librenms section of the config file.
 
-                # Some serials in inventory items have a S/N as their first token.
-                if inventory_item["serial"].startswith("S/N "):
-                    inventory_item["serial"] = inventory_item["serial"].split(" ", 1)[1]
-                self.inventory[inventory_item["serial"]] = inventory_item
+        Returns:
+            LibreNMSData: the data, which must not be modified as it is shared.
 
+        """
+        with self._lock:
+            try:
+                connection = self._connect(config)
+                with connection.cursor() as cursor:
+                    cursor.execute(CHANGE_QUERY)
+                    fingerprint = cursor.fetchone()
+
+                if (
+                    self._data is None
+                    or time.monotonic() - self._loaded >= config.getint("cache_ttl", fallback=CACHE_TTL)
+                    or fingerprint != self._fingerprint
+                ):
+                    self._data = None  # release the memory before loading the data again
+                    self._data = LibreNMSData.from_connection(connection)
+                    self._loaded = time.monotonic()
+                    self._fingerprint = fingerprint
+            except pymysql.MySQLError:
+                self._close()
+                raise
+
+            return self._data
+
+    def _connect(self, config):
+        """Get the connection, opening it the first time and whenever it was lost."""
+        if self._connection is not None:
+            try:
+                self._connection.ping(reconnect=False)
+                return self._connection
+            except pymysql.MySQLError:
+                self._close()
+
+        timeout = config.getint("timeout", fallback=LIBRENMS_TIMEOUT)
+        self._connection = pymysql.connect(
+            host=config["dbhost"],
+            port=int(config["dbport"]),
+            user=config["user"],
+            password=config["password"],
+            database=config["database"],
+            connect_timeout=timeout,
+            read_timeout=timeout,
+            write_timeout=timeout,
+        )
+        return self._connection
 
-class LibreNMS(Report):
+    def _close(self):
+        if self._connection is not None:
+            try:
+                self._connection.close()
+            except pymysql.MySQLError:
+                pass  # already closed
+            self._connection = None
+
+    def close(self):
+        """Close the connection, which is opened again if needed."""
+        with self._lock:
+            self._close()
+
+
+class LibreNMS(ParallelMixin, InstrumentationMixin, Report):
     description = __doc__
+    preload = ("sources.librenms", "_netbox.devices")
 
     def __init__(self, *args, **kwargs):
-        """Load the data from the endpoint as needed by the reports."""
-        configfile = configparser.ConfigParser()
-        configfile.read(CONFIG_FILE)
-        config = configfile["librenms"]
-
+        """Set up the lazy loading of the data from the endpoint as needed by the reports."""
         self._device_query = Device.objects.filter(status__in=INCLUDE_STATUSES)
 
-        self._librenms = LibreNMSData(
-            config["dbhost"], config["dbport"], config["user"], config["password"], config["database"]
-        )
+        self.sources = DataProvider(on_load=log_load_time(self), librenms=self._load_librenms)
+        self._netbox = DataProvider(devices=self._get_netbox_devices)
 
         super().__init__(*args, **kwargs)
 
+    @property
+    def netbox_devices(self):
+        """The NetboxDevice of every device with a status in INCLUDE_STATUSES, keyed by pk, built on first access."""
+        return self._netbox.devices
+
+    def _get_netbox_devices(self):
+        """Get the NetboxDevice of every device with a status in INCLUDE_STATUSES, in query order, with one query."""
+        excluded = {
+            name: Case(When(q, then=Value(True)), default=Value(False), output_field=BooleanField())
+            for name, q in (("model_excluded", MODEL_EXCLUDES), ("device_excluded", DEVICE_EXCLUDES))
+        }
+        return OrderedDict(
+            (row[0], NetboxDevice(*row))
+            for row in self._device_query.annotate(**excluded).values_list(
+                "pk",
+                "serial",
+                "device_role__slug",
+                "device_type__manufacturer__name",
+                "device_type__manufacturer__slug",
+                "device_type__model",
+                "site__slug",
+                "model_excluded",
+                "device_excluded",
+            )
+        )
+
+    @staticmethod
+    def _load_librenms():
+        """Load the LibreNMS data using the connection parameters from the config file, through the process cache."""
+        configfile = configparser.ConfigParser()
+        configfile.read(CONFIG_FILE)
+
+        return process_singleton("librenms", LibreNMSCache).get(configfile["librenms"])
+
     def test_nb_net_in_librenms(self):
         """Check that every Device in the asw, pfw, msw, and cr classes in Netbox are `devices` in LibreNMS,
         matched by serial number.
@@ -151,56 +400,80 @@ class LibreNMS(Report):
         msw from Netgear do not appear in LibreNMS and are excluded.
         """
 
+        librenms = self.sources.librenms
         success = 0
-        for dev in (
-            self._device_query.filter(device_role__slug__in=INCLUDE_DEVICE_ROLES)
-            .exclude(MODEL_EXCLUDES)
-            .exclude(serial__exact="")
-            .exclude(DEVICE_EXCLUDES)
-        ):
-            if (dev.serial in self._librenms.devices) or (
-                (dev.device_type.manufacturer.slug in INVENTORY_MANUFACTURERS)
-                and (dev.serial in self._librenms.inventory)
+        failures = []
+        for dev in self.netbox_devices.values():
+            if dev.role not in INCLUDE_DEVICE_ROLES or dev.model_excluded or dev.serial == "" or dev.device_excluded:
+                continue
+            if (dev.serial in librenms.devices) or (
+                (dev.vendor_slug in INVENTORY_MANUFACTURERS) and (dev.serial in librenms.inventory)
             ):
                 success += 1
-            elif dev.site.slug not in EXCLUDE_SITES:
-                self.log_failure(dev, "missing Netbox device from LibreNMS of role {}".format(dev.device_role.slug))
+            elif dev.site not in EXCLUDE_SITES:
+                failures.append(dev)
+
+        failing_devices = Device.objects.in_bulk([dev.pk for dev in failures])
+        for dev in failures:
+            self.log_failure(failing_devices[dev.pk], "missing Netbox device from LibreNMS of role {}".format(dev.role))
 
         self.log_success(None, "{} Netbox devices in LibreNMS".format(success))
 
     def test_nb_inventory_in_librenms(self):
         """Check that every InventoryItem attached to a Device in Netbox, is in `entPhysical` table in librenms, matched
         by serial number."""
+        inventory = self.sources.librenms.inventory
         success = 0
-        parents = self._device_query.values_list("pk", flat=True).filter(device_role__slug__in=INCLUDE_DEVICE_ROLES)
-        for inventory_item in (
-            InventoryItem.objects.filter(device_id__in=parents)
+        failures = []
+        parents = {dev.pk: dev for dev in self.netbox_devices.values() if dev.role in INCLUDE_DEVICE_ROLES}
+        for pk, serial, device_id in (
+            InventoryItem.objects.filter(
+                device_id__in=self._device_query.filter(device_role__slug__in=INCLUDE_DEVICE_ROLES).values("pk")
+            )
             .exclude(serial__isnull=True)
             .exclude(serial="")
             .exclude(INVENTORY_EXCLUDES)
+            .values_list("pk", "serial", "device_id")
         ):
-            if (
-                inventory_item.serial not in self._librenms.inventory
-                and inventory_item.device.site.slug not in EXCLUDE_SITES
-            ):
-                self.log_failure(inventory_item, "missing Netbox inventory item from LibreNMS")
+            if device_id not in parents:  # a device updated since the table was built
+                continue
+            if serial not in inventory and parents[device_id].site not in EXCLUDE_SITES:
+                failures.append(pk)
             else:
                 success += 1
 
+        failing_items = InventoryItem.objects.in_bulk(failures)
+        for pk in failures:
+            self.log_failure(failing_items[pk], "missing Netbox inventory item from LibreNMS")
+
         self.log_success(None, "{} Netbox inventory items in LibreNMS".format(success))
 
+    def test_librenms_duplicate_serials(self):
+        """Check that serial numbers are unique among the LibreNMS `devices` and among the `entPhysical` items."""
+        for label, duplicates in (
+            ("devices", self.sources.librenms.device_duplicates),
+            ("inventory items", self.sources.librenms.inventory_duplicates),
+        ):
+            for serial, count in sorted(duplicates.items()):
+                self.log_failure(
+                    None, "duplicate serial in LibreNMS {}: serial: {} count: {}".format(label, serial, count)
+                )
+
+        if not (self.sources.librenms.device_duplicates or self.sources.librenms.inventory_duplicates):
+            self.log_success(None, "No duplicate serials in LibreNMS")
+
     def test_librenms_in_nb(self):
         """Check that every `device` in LibreNMS exists as a Device in Netbox, matched by serial number."""
         success = 0
-        devserials = self._device_query.filter(device_role__slug__in=INCLUDE_DEVICE_ROLES_LNMS_CHECK).values_list(
-            "serial", flat=True
+        devserials = frozenset(
+            dev.serial for dev in self.netbox_devices.values() if dev.role in INCLUDE_DEVICE_ROLES_LNMS_CHECK
         )
-        for serial, device in self._librenms.devices.items():
+        for serial, device in self.sources.librenms.devices.items():
             if serial not in devserials:
                 self.log_failure(
                     None,
                     "missing LibreNMS device from Netbox: serial: {} hostname: {} id: {}".format(
-                        serial, device["hostname"], device["id"]
+                        serial, device.hostname, device.id
                     ),
                 )
             else:
@@ -218,55 +491,61 @@ class LibreNMS(Report):
         details and other things at the end of the string which are not relevant to this test (in an effort to be
         as general a check as possible without special exceptions).
         """
+        devices = [
+            dev for dev in self.netbox_devices.values() if dev.role in INCLUDE_DEVICE_ROLES and not dev.model_excluded
+        ]
+        # Compile the matcher of all the Netbox vendor and model strings the LibreNMS strings can contain
+        patterns = set(MODEL_EQUIVS.values())
+        for dev in devices:
+            nb_vendor_string, nb_model_string = dev.vendor.lower(), dev.model.lower()
+            patterns.update((nb_vendor_string, nb_model_string, " ".join((nb_vendor_string, nb_model_string))))
+        matcher = SubstringMatcher(patterns)
+
         success = 0
-        for device in self._device_query.filter(device_role__slug__in=INCLUDE_DEVICE_ROLES).exclude(MODEL_EXCLUDES):
-            nb_vendor_string = str(device.device_type.manufacturer).lower()
-            nb_model_string = str(device.device_type.model).lower()
+        failures = []
+        for dev in devices:
+            nb_vendor_string = dev.vendor.lower()
+            nb_model_string = dev.model.lower()
             nb_vendor_model_string = " ".join((nb_vendor_string, nb_model_string))
             # Either the hardware or description has both the vendor and the model, discretely.
-            if device.serial in self._librenms.devices:
-                if (
-                    nb_vendor_string in self._librenms.devices[device.serial]["hardware"]
-                    or nb_vendor_string in self._librenms.devices[device.serial]["description"]
-                ) and (
-                    nb_model_string in self._librenms.devices[device.serial]["hardware"]
-                    or nb_model_string in self._librenms.devices[device.serial]["description"]
-                ):
+            if dev.serial in self.sources.librenms.devices:
+                librenms_device = self.sources.librenms.devices[dev.serial]
+                found = matcher.find(librenms_device.hardware) | matcher.find(librenms_device.description)
+                if nb_vendor_string in found and nb_model_string in found:
                     success += 1
-                elif device.site.slug not in EXCLUDE_SITES:
-                    self.log_failure(
-                        device,
+                elif dev.site not in EXCLUDE_SITES:
+                    failures.append(
                         (
-                            "mismatch between LibreNMS and Netbox device types: Netbox devtype={}, "
-                            "LibreNMS devtype={} || {}"
-                        ).format(
-                            nb_vendor_model_string,
-                            self._librenms.devices[device.serial]["description"],
-                            self._librenms.devices[device.serial]["hardware"],
-                        ),
+                            dev.pk,
+                            (
+                                "mismatch between LibreNMS and Netbox device types: Netbox devtype={}, "
+                                "LibreNMS devtype={} || {}"
+                            ).format(nb_vendor_model_string, librenms_device.description, librenms_device.hardware),
+                        )
                     )
-            elif device.serial in self._librenms.inventory:
-                librenms_vendor_model_string = (
-                    self._librenms.inventory[device.serial]["vendor"]
-                    + " "
-                    + self._librenms.inventory[device.serial]["model"]
-                )
+            elif dev.serial in self.sources.librenms.inventory:
+                librenms_item = self.sources.librenms.inventory[dev.serial]
+                librenms_vendor_model_string = librenms_item.vendor + " " + librenms_item.model
+                found = matcher.find(librenms_vendor_model_string)
                 if (
-                    nb_vendor_model_string in librenms_vendor_model_string
-                    or (
-                        nb_vendor_string in librenms_vendor_model_string
-                        and nb_model_string in librenms_vendor_model_string
-                    )
-                    or MODEL_EQUIVS.get(nb_vendor_model_string, "BADMATCH") in librenms_vendor_model_string
+                    nb_vendor_model_string in found
+                    or (nb_vendor_string in found and nb_model_string in found)
+                    or MODEL_EQUIVS.get(nb_vendor_model_string) in found
                 ):
                     success += 1
-                elif device.site.slug not in EXCLUDE_SITES:
-                    self.log_failure(
-                        device,
+                elif dev.site not in EXCLUDE_SITES:
+                    failures.append(
                         (
-                            "mismatch between LibreNMS and Netbox device types: Netbox devtype={}, "
-                            "LibreNMS devtype={}"
-                        ).format(nb_vendor_model_string, librenms_vendor_model_string),
+                            dev.pk,
+                            (
+                                "mismatch between LibreNMS and Netbox device types: Netbox devtype={}, "
+                                "LibreNMS devtype={}"
+                            ).format(nb_vendor_model_string, librenms_vendor_model_string),
+                        )
                     )
 
+        failing_devices = Device.objects.in_bulk([pk for pk, _ in failures])
+        for pk, message in failures:
+            self.log_failure(failing_devices[pk], message)
+
         self.log_success(None, "{} LibreNMS hardware and manufacturer matches in Netbox".format(success))
@@ -2,8 +2,10 @@
 Check certain kinds of devices for the presence of a console port.
 """
 
+import os
+import sys
+
 from dcim.constants import (
-    CONNECTION_STATUS_CONNECTED,
     DEVICE_STATUS_DECOMMISSIONING,
     DEVICE_STATUS_INVENTORY,
     DEVICE_STATUS_OFFLINE,
@@ -12,6 +14,11 @@ from dcim.constants import (
 from dcim.models import Device
 from extras.reports import Report
 
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import ConsolePortIndex, InstrumentationMixin  # noqa: E402
+
 # These are the device type slugs we care about.
 # Currently we alert on Core Routers and Core/Access Switch
 DEVICE_ROLES = ("cr", "asw", "mr", "pfw")
@@ -21,12 +28,12 @@ DEVICE_ROLES = ("cr", "asw", "mr", "pfw")
 EXCLUDED_SITES = ("eqord", "eqdfw", "knams")
 
 
-class ManagementConsole(Report):
+class ManagementConsole(InstrumentationMixin, Report):
     description = __doc__
 
     def test_management_console(self):
         successcount = 0
-        for device in (
+        devices = (
             Device.objects.exclude(
                 status__in=(
                     DEVICE_STATUS_INVENTORY,
@@ -37,17 +44,13 @@ class ManagementConsole(Report):
             )
             .filter(device_role__slug__in=DEVICE_ROLES)
             .exclude(site__slug__in=EXCLUDED_SITES)
-        ):
-            ports = device.consoleports.all()
-
-            if not ports:
+        )
+        consoleports = ConsolePortIndex(devices)
+        for device in devices:
+            if not consoleports.total(device):
                 self.log_failure(device, "missing console port")
-                continue
-
-            for port in ports:
-                if port.connection_status == CONNECTION_STATUS_CONNECTED:
-                    successcount += 1
-                    break
+            elif consoleports.connected(device):
+                successcount += 1
             else:
                 self.log_failure(device, "missing connected console port")
         self.log_success(None, "{} devices with connected ports".format(successcount))
@@ -3,7 +3,13 @@ Report parity errors between PuppetDB and Netbox.
 """
 
 import configparser
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from dcim.constants import (
     DEVICE_STATUS_DECOMMISSIONING,
@@ -16,8 +22,16 @@ from dcim.models import Device
 from extras.reports import Report
 from virtualization.models import VirtualMachine
 
+REPORTS_DIR = os.path.dirname(os.path.abspath(__file__))
+if REPORTS_DIR not in sys.path:  # for importing _common, see its docstring
+    sys.path.append(REPORTS_DIR)
+from _common import DataProvider, InstrumentationMixin, ParallelMixin, log_load_time  # noqa: E402
+
 CONFIG_FILE = "/etc/netbox/reports.cfg"
 
+# Default timeout in seconds for each PuppetDB request, can be overridden with the timeout key in the config file.
+PUPPETDB_TIMEOUT = 30.0
+
 # slugs for roles which we care about
 INCLUDE_ROLES = ("server",)
 
@@ -31,36 +45,107 @@ EXCLUDE_STATUSES = (
 EXCLUDE_AND_FAILED_STATUSES = EXCLUDE_STATUSES + (DEVICE_STATUS_FAILED,)
 
 
-class PuppetDB(Report):
+class PuppetDB(ParallelMixin, InstrumentationMixin, Report):
     description = __doc__
+    preload = ("sources.facts", "_netbox.devices", "_netbox.vms")
 
     def __init__(self, *args, **kwargs):
-        """Load the data from the endpoint as needed by the reports."""
+        """Set up the lazy loading of the data from the endpoint as needed by the reports."""
         self.config = configparser.ConfigParser()
         self.config.read(CONFIG_FILE)
 
-        self.puppetdb_serials = self._get_puppetdb_fact("serialnumber")
-        self.puppetdb_devices = self._get_puppetdb_fact("is_virtual")
-        self.puppetdb_models = self._get_puppetdb_fact("productname")
+        self.sources = DataProvider(
+            on_load=log_load_time(self),
+            facts=lambda: self._get_puppetdb_facts(("serialnumber", "is_virtual", "productname")),
+        )
         self.device_query = Device.objects.filter(device_role__slug__in=INCLUDE_ROLES, tenant__isnull=True)
+        self._netbox = DataProvider(devices=self._get_netbox_devices, vms=self._get_netbox_vms)
 
         super().__init__(*args, **kwargs)
 
-    def _get_puppetdb_fact(self, fact):
+    @property
+    def puppetdb_serials(self):
+        """The PuppetDB serial numbers keyed by device name, loaded on first access."""
+        return self.sources.facts["serialnumber"]
+
+    @property
+    def puppetdb_devices(self):
+        """Whether the PuppetDB hosts are virtual keyed by host name, loaded on first access."""
+        return self.sources.facts["is_virtual"]
+
+    @property
+    def puppetdb_models(self):
+        """The PuppetDB product names keyed by device name, loaded on first access."""
+        return self.sources.facts["productname"]
+
+    @property
+    def netbox_devices(self):
+        """Index of the Netbox devices as (status, pk) keyed by name, built on first access.
+
+        If the same name is used by several devices, one with a status not in EXCLUDE_STATUSES takes precedence.
+        """
+        return self._netbox.devices
+
+    @property
+    def netbox_vms(self):
+        """The set of names of the Netbox VMs which are not offline, built on first access."""
+        return self._netbox.vms
+
+    def _get_netbox_devices(self):
+        devices = {}
+        for name, status, pk in self.device_query.values_list("name", "status", "pk").order_by():
+            if name not in devices or status not in EXCLUDE_STATUSES:
+                devices[name] = (status, pk)
+        return devices
+
+    @staticmethod
+    def _get_netbox_vms():
+        return frozenset(VirtualMachine.objects.exclude(status=DEVICE_STATUS_OFFLINE).values_list("name", flat=True))
+
+    def _get_puppetdb_facts(self, facts):
+        """Query the PuppetDB proxy for the specified facts concurrently, over a single pooled keep-alive session.
+
+        Arguments:
+           facts (sequence): The fact names to query
+
+        Returns:
+            dict: Keyed by fact name, with the value as returned by _get_puppetdb_fact().
+
+        Raises:
+            Exception: on communication failure or timeout.
+
+        """
+        with requests.Session() as session:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(facts))
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.verify = self.config["puppetdb"]["ca_cert"]
+            session.headers["Accept-Encoding"] = "gzip"
+
+            with ThreadPoolExecutor(max_workers=len(facts)) as executor:
+                return dict(zip(facts, executor.map(partial(self._get_puppetdb_fact, session), facts)))
+
+    def _get_puppetdb_fact(self, session, fact):
         """Query the PuppetDB proxy for a specified fact.
 
         Arguments:
+           session (requests.Session): The session to perform the request with
            fact (str): The fact name to query
 
         Returns:
             dict: Keyed by short devicename, with te value.
 
         Raises:
-            Exception: on communication failure.
+            Exception: on communication failure or timeout.
 
         """
         url = "/".join([self.config["puppetdb"]["url"], "/v1/facts", fact])
-        response = requests.get(url, verify=self.config["puppetdb"]["ca_cert"])
+        timeout = self.config["puppetdb"].getfloat("timeout", fallback=PUPPETDB_TIMEOUT)
+        try:
+            response = session.get(url, timeout=timeout)
+        except requests.exceptions.Timeout:
+            raise Exception("Timed out after {}s querying PuppetDB {}".format(timeout, url))
+
         if response.status_code != 200:
             raise Exception("Cannot connect to PuppetDB {} - {} {}".format(url, response.status_code, response.text))
 
@@ -68,24 +153,30 @@ class PuppetDB(Report):
 
     def test_puppetdb_in_netbox(self):
         """Check that all PuppetDB physical devices are in Netbox."""
-        valid_netbox_devices = self.device_query.exclude(status__in=EXCLUDE_STATUSES).values_list("name", flat=True)
-        invalid_netbox_devices = self.device_query.filter(status__in=EXCLUDE_STATUSES).values_list("name", flat=True)
-
         success = 0
+        failures = []  # (device name, Netbox pk or None), in PuppetDB order
         for device, is_virtual in self.puppetdb_devices.items():
             if is_virtual:
                 continue
 
-            if device in valid_netbox_devices:
+            status, pk = self.netbox_devices.get(device, (None, None))
+            if pk is None:
+                failures.append((device, None))
+            elif status not in EXCLUDE_STATUSES:
                 success += 1
-            elif device in invalid_netbox_devices:
-                invalid_device = Device.objects.get(name=device)
+            else:
+                failures.append((device, pk))
+
+        invalid_devices = Device.objects.in_bulk([pk for _, pk in failures if pk is not None])
+        for device, pk in failures:
+            if pk is None:
+                self.log_failure(None, "expected device missing from Netbox: {}".format(device))
+            else:
+                invalid_device = invalid_devices[pk]
                 self.log_failure(
                     invalid_device,
                     "unexpected state for physical device: {} in netbox".format(invalid_device.get_status_display()),
                 )
-            else:
-                self.log_failure(None, "expected device missing from Netbox: {}".format(device))
 
         self.log_success(None, "{} physical devices that are in PuppetDB are also in Netbox".format(success))
 
@@ -150,14 +241,13 @@ class PuppetDB(Report):
 
     def test_puppetdb_vms_in_netbox(self):
         """Check that all PuppetDB VMs are in Netbox VMs."""
-        vms = list(VirtualMachine.objects.exclude(status=DEVICE_STATUS_OFFLINE).values_list("name", flat=True))
         success = 0
 
         for device, is_virtual in self.puppetdb_devices.items():
             if not is_virtual:
                 continue
 
-            if device not in vms:
+            if device not in self.netbox_vms:
                 self.log_failure(None, "missing VM from Netbox: {} ".format(device))
             else:
                 success += 1